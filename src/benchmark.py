@@ -0,0 +1,339 @@
+"""
+Offline end-to-end benchmark of the per parcel pipeline.
+
+Synthetic dem, BA and NAIP data are generated around a fixed point and
+served through the local stand-ins of standins.py, so no 3DEP, S3 or RAVG
+access is needed. For each parcel set size the stages are timed
+(wall and cpu seconds) on cold caches, the results written as json and
+compared against a stored baseline.
+
+    python benchmark.py --sizes parcel ranch --quality preview
+    python benchmark.py --save-baseline
+
+Everything runs in a scratch directory laid out like the repository
+(work/src is the working directory, so the pipeline's ../data, ../fig
+paths land in work/).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+import geopandas as gp
+import shapely.geometry
+import pyproj
+
+import standins
+
+# area [km2] of the parcel set and number of parcels in it
+SIZES = {'parcel': (0.05, 1), 'ranch': (1, 16), 'watershed': (25, 400)}
+CENTER = (-121.344, 40.453)  # lon, lat, middle of a naip quarter quad
+DST_CRS = 'epsg:32610'  # as in workflow.py
+BA_CRS = 'epsg:5070'
+NAIP_CRS = 'epsg:26910'
+BA_RES = 30
+NAIP_RES = 5.0  # much coarser than real naip (0.6 m) to keep the data small
+DEM_BUFFER = 15  # as in workflow.py
+MAP_BUFFER = 25000  # BA raster margin, covers the 20 km map crop
+RESULTS_FILE = '../benchmark.json'
+BASELINE_FILE = '../benchmark_baseline.json'
+TOLERANCE = 0.25  # allowed slowdown relative to the baseline
+MIN_DELTA = 0.1  # seconds, smaller differences are noise
+
+
+def center_utm():
+    trans = pyproj.Transformer.from_crs('epsg:4326', DST_CRS, always_xy=True)
+    return trans.transform(*CENTER)
+
+
+def make_parcels(area_km2, count):
+    """
+    GeoDataFrame (epsg:4326) of count square parcels tiling a square of
+    area_km2 around CENTER
+    """
+    side = np.sqrt(area_km2)*1000
+    per_row = int(np.ceil(np.sqrt(count)))
+    cell = side/per_row
+    x0, y0 = center_utm()
+    x0, y0 = x0 - side/2, y0 - side/2
+    geoms = [shapely.geometry.box(x0 + (i % per_row)*cell, y0 + (i // per_row)*cell,
+                                  x0 + (i % per_row + 1)*cell - 1,
+                                  y0 + (i // per_row + 1)*cell - 1)
+             for i in range(count)]
+    names = [f'{i:09d}' for i in range(count)]
+    return gp.GeoDataFrame({'Name': names}, geometry=geoms,
+                           crs=DST_CRS).to_crs('epsg:4326')
+
+
+def make_ba(outfile, bounds_utm):
+    """
+    Smooth 0-100 % BA loss at 30 m in an equal area crs, covering
+    bounds_utm plus the map margin
+    """
+    left, bottom, right, top = transform_bounds(
+        DST_CRS, BA_CRS, bounds_utm[0]-MAP_BUFFER, bounds_utm[1]-MAP_BUFFER,
+        bounds_utm[2]+MAP_BUFFER, bounds_utm[3]+MAP_BUFFER)
+    width = int((right-left)/BA_RES)
+    height = int((top-bottom)/BA_RES)
+    yy, xx = np.mgrid[0:height, 0:width]
+    ba = 50 + 45*np.sin(xx/37.)*np.cos(yy/23.) + 5*np.sin((xx+yy)/5.)
+    with rasterio.open(outfile, 'w', driver='GTiff', width=width, height=height,
+                       count=1, dtype='float32', crs=BA_CRS,
+                       transform=from_origin(left, top, BA_RES, BA_RES),
+                       compress='deflate') as dst:
+        dst.write(np.clip(ba, 0, 100).astype(np.float32), 1)
+    return outfile
+
+
+def make_naip(naip_dir, bounds_ll, quad_file, manifest_file):
+    """
+    Topo quads (7.5') covering bounds_ll with the four naip quarter quads
+    of each written to naip_dir, plus the quad geojson and the bucket
+    manifest naip.py reads. Returns {s3 key: local file}.
+    """
+    import naip
+
+    os.makedirs(naip_dir, exist_ok=True)
+    step = 0.125
+    features, objects = [], {}
+    lon0 = np.floor(bounds_ll[0]/step)*step
+    lat0 = np.floor(bounds_ll[1]/step)*step
+    for lon in np.arange(lon0, bounds_ll[2], step):
+        for lat in np.arange(lat0, bounds_ll[3], step):
+            # quads are lettered from the south, numbered from the east
+            deg_lat, deg_lon = int(np.floor(lat)), int(np.floor(-lon))
+            row = int(round((lat - deg_lat)/step))
+            col = int(round((-(lon+step) - deg_lon)/step))
+            qd_id = f'{deg_lat}{deg_lon:03d}-{"ABCDEFGH"[row]}{col+1}'
+            quad = shapely.geometry.box(lon, lat, lon+step, lat+step)
+            features.append({'type': 'Feature',
+                             'properties': {'ST_NAME1': 'California',
+                                            'USGS_QD_ID': qd_id},
+                             'geometry': shapely.geometry.mapping(quad)})
+            qd_num = naip.add_quad_num(qd_id)
+            for name, (dx, dy) in {'sw': (0, 0), 'se': (1, 0),
+                                   'nw': (0, 1), 'ne': (1, 1)}.items():
+                filename = f'm_{qd_num}_{name}_10_060_20200620.tif'
+                key = f'ca/2020/60cm/rgbir/{qd_num[:-2]}/{filename}'
+                bounds = (lon + dx*step/2, lat + dy*step/2,
+                          lon + (dx+1)*step/2, lat + (dy+1)*step/2)
+                objects[key] = write_naip_tile(os.path.join(naip_dir, filename),
+                                               bounds)
+
+    with open(quad_file, 'w') as f:
+        json.dump({'type': 'FeatureCollection',
+                   'crs': {'type': 'name', 'properties': {'name': 'EPSG:4326'}},
+                   'features': features}, f)
+    with open(manifest_file, 'w') as f:
+        f.write(''.join(f'{key}\n' for key in objects))
+    return objects
+
+
+def write_naip_tile(outfile, bounds_ll):
+    left, bottom, right, top = transform_bounds('epsg:4326', NAIP_CRS, *bounds_ll)
+    width = int((right-left)/NAIP_RES)
+    height = int((top-bottom)/NAIP_RES)
+    yy, xx = np.mgrid[0:height, 0:width]
+    x = left + xx*NAIP_RES
+    y = top - yy*NAIP_RES
+    base = 0.5 + 0.25*np.sin(x/400.) + 0.25*np.cos(y/300.)
+    bands = [base, base**2, 1 - base, np.sqrt(base)]
+    data = np.stack([np.clip(b*255, 0, 255) for b in bands]).astype(np.uint8)
+    with rasterio.open(outfile, 'w', driver='GTiff', width=width, height=height,
+                       count=4, dtype='uint8', crs=NAIP_CRS,
+                       transform=from_origin(left, top, NAIP_RES, NAIP_RES),
+                       compress='deflate', tiled=True) as dst:
+        dst.write(data)
+    return outfile
+
+
+def setup(workdir, src_dir):
+    """
+    Scratch tree with synthetic data for the largest size, stand-ins
+    started and the pipeline pointed at them. Returns the dem url and the
+    synthetic BA file.
+    """
+    os.makedirs(os.path.join(workdir, 'src'), exist_ok=True)
+    for name in ['document.tex', 'df_style.css']:
+        shutil.copy(os.path.join(src_dir, name), os.path.join(workdir, 'src', name))
+    os.chdir(os.path.join(workdir, 'src'))
+    os.makedirs('../data/NAIP', exist_ok=True)
+
+    dem_url, _ = standins.start_dem_service()
+    objects = {}
+    s3_url, _ = standins.start_s3_service(objects)
+    # read by downloader at import, so before any pipeline module loads
+    os.environ['NAIP_S3_ENDPOINT'] = s3_url
+    for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        os.environ.setdefault(key, 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+    largest = make_parcels(*max(SIZES.values()))
+    ba_file = make_ba('../data/ba.tif', largest.to_crs(DST_CRS).total_bounds)
+    objects.update(make_naip('../data/naip_source', largest.total_bounds,
+                             '../data/NAIP/usgs_topo_quads.geojson',
+                             '../data/NAIP/manifest.txt'))
+    return dem_url, ba_file
+
+
+def timed(timings, stage, func, *args, **kwargs):
+    wall, cpu = time.perf_counter(), time.process_time()
+    out = func(*args, **kwargs)
+    timings[stage] = {'wall': round(time.perf_counter() - wall, 4),
+                      'cpu': round(time.process_time() - cpu, 4)}
+    print(f'  {stage}: {timings[stage]["wall"]:.2f}s')
+    return out
+
+
+def ba_chain(ba_file, aoi_utm, demfile, figdir):
+    import utils as reutil
+    from rasterio.warp import Resampling
+
+    # as in workflow.process_apn: the reprojection is a file (cached there),
+    # the parcel crop and resampling are in memory
+    ba_utm = reutil.geotiff_to_utm(ba_file, f'{figdir}/ba_utm.tif', DST_CRS)
+    ba_crop = reutil.crop_to_aoi(ba_utm, aoi_utm.buffer(30))
+    with rasterio.open(demfile) as src:
+        res = src.res
+    return reutil.geotiff_to_utm(ba_crop, dst_crs=DST_CRS, resolution=res,
+                                 resampling=Resampling.nearest)
+
+
+def run_size(size, dem_url, ba_file, quality='preview'):
+    """
+    Stage timings of one parcel set size, on caches of its own
+    """
+    import usgs_dsm
+    import naip
+    import plotting
+    import document
+    import folium_map
+    import workflow
+
+    area_km2, count = SIZES[size]
+    print(f'{size}: {area_km2} km2, {count} parcels')
+    parcels = make_parcels(area_km2, count)
+    aoi = gp.GeoDataFrame({'Name': [size]}, geometry=[parcels.unary_union],
+                          crs=parcels.crs)
+    aoi_utm = aoi.to_crs(DST_CRS)
+    aoi_buf = aoi_utm.buffer(DEM_BUFFER).to_crs('epsg:4326')
+    figdir = f'../fig/{size}'
+    os.makedirs(figdir, exist_ok=True)
+    naip.NAIP_DIR = os.path.abspath(f'../data/naip_{size}')
+    plotting.set_quality(quality)
+
+    timings = {}
+    demfile = timed(timings, 'get_dsm_tiff', usgs_dsm.get_dsm_tiff, aoi_buf,
+                    f'{figdir}/dem.tif', dst_crs=DST_CRS, overwrite=True,
+                    base_url=dem_url, tile_dir=f'../data/dem_tiles_{size}')
+    hillshade_file, slope_file, _ = timed(timings, 'dsm_products',
+                                          usgs_dsm.dsm_products, demfile)
+    ba_crop = timed(timings, 'ba_to_dem_grid', ba_chain, ba_file, aoi_utm,
+                    demfile, figdir)
+    naip_file = timed(timings, 'get_masked_raster', naip.get_masked_raster,
+                      aoi, masked_file=f'{figdir}/naip.tif')
+    timed(timings, 'plot_regen', plotting.plot_regen, slope_file, ba_crop,
+          naip_file, aoi_utm, figdir)
+    jobs = [('plot_ba', (ba_crop, aoi_utm, figdir), {}),
+            ('plot_slope', (slope_file, aoi_utm, figdir), {}),
+            ('plot_contour', (demfile, aoi_utm, figdir),
+             dict(zip(['intv', 'cont', 'linethick', 'cfont'],
+                      workflow.contour_params((aoi_utm.area/1e6).iloc[0])))),
+            ('plot_naip', (naip_file, aoi_utm, figdir), {}),
+            ('plot_hill', (hillshade_file, aoi_utm, figdir), {})]
+    timed(timings, 'other_figures', plotting.render, jobs, quality=quality)
+    if shutil.which('pdflatex'):
+        timed(timings, 'make_document', document.make_document, figdir,
+              force=True)
+    else:
+        print('  make_document: skipped, no pdflatex')
+    timed(timings, 'folium_map.warner', folium_map.warner, parcels,
+          ba_file=ba_file, outfile=f'../map_{size}.html',
+          tile_dir=f'../tiles_{size}/')
+    return timings
+
+
+def compare(results, baseline, tolerance=TOLERANCE, min_delta=MIN_DELTA):
+    """
+    Stages slower than the baseline by more than tolerance (and min_delta
+    seconds), as printable lines
+    """
+    regressions = []
+    for size, stages in results['sizes'].items():
+        for stage, timing in stages.items():
+            base = baseline.get('sizes', {}).get(size, {}).get(stage)
+            if base is None:
+                continue
+            delta = timing['wall'] - base['wall']
+            if delta > min_delta and timing['wall'] > base['wall']*(1 + tolerance):
+                regressions.append(f'{size} {stage}: {timing["wall"]:.2f}s, '
+                                   f'baseline {base["wall"]:.2f}s')
+    return regressions
+
+
+def run(sizes, workdir, quality='preview'):
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+    start = time.perf_counter()
+    dem_url, ba_file = setup(workdir, src_dir)
+    setup_time = time.perf_counter() - start
+    try:
+        timings = {size: run_size(size, dem_url, ba_file, quality=quality)
+                   for size in sizes}
+    finally:
+        os.chdir(cwd)
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': sys.version.split()[0],
+                     'platform': platform.platform(),
+                     'cpus': os.cpu_count(),
+                     'quality': quality,
+                     'setup_seconds': round(setup_time, 2)},
+            'sizes': timings}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES),
+                        default=list(SIZES))
+    parser.add_argument('--quality', choices=['preview', 'production'],
+                        default='preview')
+    parser.add_argument('--workdir', help='scratch directory (default: a temp dir, removed)')
+    parser.add_argument('--out', default=RESULTS_FILE)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    out_file = os.path.abspath(args.out)
+    baseline_file = os.path.abspath(args.baseline)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        results = run(args.sizes, os.path.abspath(workdir), quality=args.quality)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(out_file, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'results written to {out_file}')
+
+    if args.save_baseline:
+        shutil.copy(out_file, baseline_file)
+        print(f'baseline written to {baseline_file}')
+    elif os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            regressions = compare(results, json.load(f), tolerance=args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+        print('no regressions against the baseline')
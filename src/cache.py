@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+
+import utils as reutil
+
+CACHE_DIR = '../data/cache/'
+CACHE_MAX_BYTES = 20 * 1024**3
+
+
+def file_digest(path, cache_dir=CACHE_DIR):
+    """
+    sha256 of a file's contents. Digests are memoized on disk keyed by the
+    absolute path, and only recomputed when the size or mtime of the file
+    changes, so large sources are hashed once rather than once per parcel.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_dir = os.path.join(cache_dir, 'digests')
+    os.makedirs(memo_dir, exist_ok=True)
+    memo_file = os.path.join(
+        memo_dir, hashlib.sha1(path.encode()).hexdigest() + '.json')
+
+    if os.path.exists(memo_file):
+        with open(memo_file) as f:
+            memo = json.load(f)
+        if memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+            return memo['digest']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    memo = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'digest': sha.hexdigest()}
+    tmp_file = reutil.atomic_path(memo_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(memo, f)
+    os.replace(tmp_file, memo_file)
+    return memo['digest']
+
+
+def param_token(value):
+    """
+    Stable string for a transform parameter, used in the cache key.
+    Geometries are keyed by their WKB so that equal shapes hit the cache.
+    """
+    if hasattr(value, 'geometry') and hasattr(value, 'crs'):
+        # GeoSeries / GeoDataFrame
+        wkbs = [geom.wkb.hex() for geom in value.geometry]
+        return f'{value.crs}:{",".join(wkbs)}'
+    if hasattr(value, 'wkb'):
+        return value.wkb.hex()
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(param_token(v) for v in value) + ']'
+    if hasattr(value, 'name') and hasattr(value, 'value'):
+        # enums such as rasterio's Resampling
+        return f'{type(value).__name__}.{value.name}'
+    return repr(value)
+
+
+def cache_key(func, in_file, params, cache_dir=CACHE_DIR):
+    parts = [func.__module__, func.__name__,
+             file_digest(in_file, cache_dir=cache_dir)]
+    parts += [f'{k}={param_token(params[k])}' for k in sorted(params)]
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+
+def cached(func, in_file, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES,
+           **kwargs):
+    """
+    Content addressed cache around the utils.py transforms. Calls
+    func(in_file, out_file=..., **kwargs) once for each distinct input
+    file content and set of parameters and returns the path of the cached
+    output. A changed source gets a new digest and so a new key, the stale
+    entries age out through LRU eviction.
+
+    Usage:
+    ba_utm = cached(reutil.geotiff_to_utm, BA_FILE, dst_crs=DST_CRS)
+    """
+    key = cache_key(func, in_file, kwargs, cache_dir=cache_dir)
+    artifact_dir = os.path.join(cache_dir, 'artifacts')
+    os.makedirs(artifact_dir, exist_ok=True)
+    out_file = os.path.join(artifact_dir, f'{key}.tif')
+
+    if os.path.exists(out_file):
+        # touch for LRU bookkeeping
+        os.utime(out_file)
+        return out_file
+
+    # the transforms write atomically, so racing workers are harmless
+    func(in_file, out_file=out_file, **kwargs)
+    evict(artifact_dir, max_bytes, keep=[out_file])
+    return out_file
+
+
+def evict(artifact_dir, max_bytes=CACHE_MAX_BYTES, keep=()):
+    """
+    Delete least recently used artifacts until the total is under max_bytes.
+    Paths in keep (the artifact just made) are never deleted, even if that
+    leaves the total above max_bytes.
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    total = 0
+    for name in os.listdir(artifact_dir):
+        if name.endswith('.tmp'):
+            continue
+        path = os.path.join(artifact_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        total += stat.st_size
+        if os.path.abspath(path) not in keep:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
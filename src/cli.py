@@ -0,0 +1,155 @@
+"""
+Command line entry point, run from src/:
+
+    python cli.py process [--apns 011180013 ...] [--workers 4] ...
+    python cli.py table
+    python cli.py summary
+    python cli.py map
+    python cli.py doc [--apns ...]
+
+Each subcommand imports only the modules it uses, so table and summary
+start without rasterio, matplotlib, folium or boto3.
+"""
+import os
+import sys
+import argparse
+
+import instrument
+
+FIG_DIR = '../fig'
+# apns of interest: 'Tolanda' 011180013, 'Williams' 011180014,
+# 'Farmers' 011130013, all watershed 'Warner_Watershed'
+
+
+def run_process(args):
+    import parcels
+    import workflow
+
+    if args.trace:
+        instrument.configure(args.trace, args.trace_format,
+                             tracemalloc_on=args.tracemalloc,
+                             profile_stage=args.profile_stage)
+    val_gdf = parcels.watershed_parcels()
+    apns = parcels.select(val_gdf, args.apns).Name.to_list()
+    kwargs = {}
+    if args.doc_workers is not None:
+        kwargs['doc_workers'] = args.doc_workers
+    workflow.process(val_gdf, apns, workers=args.workers,
+                     plot_workers=args.plot_workers,
+                     quality='preview' if args.preview else 'production',
+                     doc_backend=args.doc_backend, force=args.force,
+                     zonal_only=args.zonal, write_figures=args.figure_files,
+                     **kwargs)
+
+
+def run_table(args):
+    import results
+    import table
+
+    source = results.ZONAL_TABLE if args.zonal else results.PARCEL_TABLE
+    try:
+        df = results.read(apns=args.apns or None, table=source)
+    except results.MissingResults as err:
+        sys.exit(f'error: {err}')
+    table.to_table(df)
+
+
+def run_summary(args):
+    import results
+    import summary
+
+    source = results.ZONAL_TABLE if args.zonal else results.PARCEL_TABLE
+    try:
+        print(summary.owners(owners_file=args.owners_file, table=source))
+    except results.MissingResults as err:
+        sys.exit(f'error: {err}')
+
+
+def run_map(args):
+    import parcels
+    import folium_map
+
+    folium_map.warner(parcels.watershed_parcels(), include_pdf=args.include_pdf)
+
+
+def run_doc(args):
+    import document
+
+    apns = args.apns or sorted(name for name in os.listdir(FIG_DIR)
+                               if os.path.isdir(os.path.join(FIG_DIR, name)))
+    kwargs = {}
+    if args.workers is not None:
+        kwargs['workers'] = args.workers
+    document.make_documents([os.path.join(FIG_DIR, apn) for apn in apns],
+                            force=args.force, **kwargs)
+
+
+def parser():
+    main_parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = main_parser.add_subparsers(dest='command', required=True)
+
+    sub = subparsers.add_parser('process', help='figures, rows, documents, '
+                                'table and map of the parcels')
+    sub.add_argument('--apns', nargs='+', help='default: every parcel')
+    sub.add_argument('--workers', type=int, default=1,
+                     help='number of parcels to process in parallel')
+    sub.add_argument('--plot-workers', type=int, default=1,
+                     help='figures of a parcel rendered in parallel')
+    sub.add_argument('--preview', action='store_true',
+                     help='render figures at preview dpi')
+    sub.add_argument('--doc-workers', type=int,
+                     help='pdflatex builds run in parallel')
+    # document.BACKENDS, not imported here to keep startup fast
+    sub.add_argument('--doc-backend', choices=('latex', 'native'),
+                     default='latex',
+                     help='build documents with pdflatex or write them natively')
+    sub.add_argument('--figure-files', action='store_true',
+                     help='native backend: also write the report pages as '
+                     'separate figure files')
+    sub.add_argument('--force', action='store_true',
+                     help='reprocess parcels even if their inputs are unchanged')
+    sub.add_argument('--trace', metavar='FILE',
+                     help='record stage timings, memory and io to FILE')
+    sub.add_argument('--trace-format', choices=instrument.FORMATS,
+                     default='jsonl')
+    sub.add_argument('--tracemalloc', action='store_true',
+                     help='also record python allocation peaks (slow)')
+    sub.add_argument('--profile-stage', metavar='STAGE',
+                     help='run this stage under cProfile (e.g. figures)')
+    sub.add_argument('--zonal', action='store_true',
+                     help='only build the table, from one watershed wide pass')
+    sub.set_defaults(func=run_process)
+
+    sub = subparsers.add_parser('table', help='table.html from the results store')
+    sub.add_argument('--apns', nargs='+', help='default: every stored parcel')
+    sub.add_argument('--zonal', action='store_true',
+                     help='rows of process --zonal instead of the per parcel rows')
+    sub.set_defaults(func=run_table)
+
+    sub = subparsers.add_parser('summary', help='summary.html, acres per owner')
+    sub.add_argument('--owners-file', default='apns.json')
+    sub.add_argument('--zonal', action='store_true',
+                     help='rows of process --zonal instead of the per parcel rows')
+    sub.set_defaults(func=run_summary)
+
+    sub = subparsers.add_parser('map', help='map.html of the parcels and BA')
+    sub.add_argument('--include-pdf', action='store_true',
+                     help='link each parcel to its document')
+    sub.set_defaults(func=run_map)
+
+    sub = subparsers.add_parser('doc', help='pdflatex documents of processed parcels')
+    sub.add_argument('--apns', nargs='+', help=f'default: every parcel in {FIG_DIR}')
+    sub.add_argument('--workers', type=int, help='pdflatex builds run in parallel')
+    sub.add_argument('--force', action='store_true',
+                     help='rebuild even if the figures are unchanged')
+    sub.set_defaults(func=run_doc)
+    return main_parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+"""
+Contour lines of a dem as cached vector data.
+
+Lines are traced once per dem content and contour settings on a grid
+decimated to what the figure can show, and stored as GeoJSON in the crs
+of the dem. plotting.plot_contour draws the stored lines, and the same
+files can be loaded by folium or any GIS.
+"""
+import os
+import json
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.enums import Resampling
+import shapely.geometry
+
+import cache
+import utils as reutil
+
+METERS_IN_FT = .3048
+CONTOUR_DIR = os.path.join(cache.CACHE_DIR, 'contours')
+# 12 inch figure, no point tracing more than ~2000 cells across
+MAX_PIXELS = 2000
+CROP = 4  # pixels of interpolated edge dropped from the dem
+
+
+def contour_levels(zmin, zmax, intv, cont):
+    lowm = np.floor(zmin)
+    highm = np.ceil(zmax)
+    return np.arange(lowm-lowm % intv, highm, cont)
+
+
+def read_decimated(demfile, max_pixels=MAX_PIXELS, crop=CROP):
+    """
+    dem without its interpolated edge, averaged down so the long side has
+    at most max_pixels cells. Returns z and the 1d cell center coordinates.
+    """
+    with rasterio.open(demfile) as src:
+        window = rasterio.windows.Window(crop, crop, src.width-2*crop,
+                                         src.height-2*crop)
+        scale = max(1, max(window.width, window.height)/max_pixels)
+        out_shape = (max(2, int(round(window.height/scale))),
+                     max(2, int(round(window.width/scale))))
+        z = src.read(1, window=window, out_shape=out_shape,
+                     resampling=Resampling.average, masked=True)
+        left, bottom, right, top = rasterio.windows.bounds(window, src.transform)
+    dx = (right-left)/out_shape[1]
+    dy = (top-bottom)/out_shape[0]
+    x = left + dx*(np.arange(out_shape[1])+0.5)
+    y = top - dy*(np.arange(out_shape[0])+0.5)
+    return z.astype(float), x, y
+
+
+def trace(x, y, z, levels):
+    """
+    List (per level) of lists of (n, 2) vertex arrays
+    """
+    try:
+        import contourpy
+    except ImportError:
+        contourpy = None
+    if contourpy is not None:
+        if not np.isfinite(z).all():
+            z = np.ma.masked_invalid(z)
+        gen = contourpy.contour_generator(x, y, z, line_type='Separate')
+        return [gen.lines(level) for level in levels]
+
+    # older matplotlib without contourpy, trace on a private figure
+    from matplotlib.figure import Figure
+    cs = Figure().add_subplot(1, 1, 1).contour(
+        x, y, np.ma.masked_invalid(z), levels)
+    return cs.allsegs
+
+
+def contour_geojson(demfile, intv, cont, meters=False, max_pixels=MAX_PIXELS):
+    """
+    FeatureCollection of contour LineStrings with properties level and
+    major (level is a multiple of intv)
+    """
+    z, x, y = read_decimated(demfile, max_pixels=max_pixels)
+    # vertices closer than half a cell to the line add nothing at this scale
+    tolerance = abs(x[1]-x[0])/2
+    if not meters:
+        z = z/METERS_IN_FT
+    levels = contour_levels(z.min(), z.max(), intv, cont)
+
+    features = []
+    for level, lines in zip(levels, trace(x, y, z, levels)):
+        for line in lines:
+            if len(line) < 2:
+                continue
+            line = shapely.geometry.LineString(line).simplify(tolerance)
+            features.append({
+                'type': 'Feature',
+                'properties': {'level': float(level),
+                               'major': bool(level % intv == 0)},
+                'geometry': {'type': 'LineString',
+                             'coordinates': np.round(line.coords, 1).tolist()}})
+    with rasterio.open(demfile) as src:
+        crs = src.crs.to_string()
+    return {'type': 'FeatureCollection',
+            'crs': {'type': 'name', 'properties': {'name': crs}},
+            'features': features}
+
+
+def get_contours(demfile, intv, cont, meters=False, max_pixels=MAX_PIXELS,
+                 contour_dir=CONTOUR_DIR):
+    """
+    Path of the cached contour GeoJSON for demfile, traced if missing.
+    Keyed by the dem contents and the contour settings.
+    """
+    digest = cache.file_digest(demfile)
+    units = 'm' if meters else 'ft'
+    outfile = os.path.join(
+        contour_dir, f'{digest[:32]}_{intv:g}_{cont:g}{units}_{max_pixels}.geojson')
+    if os.path.exists(outfile):
+        return outfile
+
+    os.makedirs(contour_dir, exist_ok=True)
+    collection = contour_geojson(demfile, intv, cont, meters=meters,
+                                 max_pixels=max_pixels)
+    tmp_file = reutil.atomic_path(outfile)
+    with open(tmp_file, 'w') as f:
+        json.dump(collection, f)
+    os.replace(tmp_file, outfile)
+    return outfile
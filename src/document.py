@@ -1,24 +1,161 @@
 import os
+import re
+import json
 import shutil
+import hashlib
+import tempfile
+import contextlib
 import subprocess
+import concurrent.futures
 
+import cache
+import instrument
+import utils as reutil
 
-def make_document(figdir):
-    texpath = f'{figdir}/document.tex'
-    shutil.copy('document.tex', texpath)
-    cwd = os.getcwd()
-    os.chdir(figdir)
-    cmd = ['pdflatex', 'document.tex', '-output-directory', '../../doc/']
-    call = subprocess.run(cmd,
-                          stdout=subprocess.PIPE,
-                          text=True)
-    apn = os.path.basename(figdir)
-    docdir = '../../doc/'
-    if not os.path.exists(docdir):
-        os.makedirs(docdir)
-    shutil.copy('document.pdf', f'{docdir}/{apn}.pdf')
-    os.chdir(cwd)
-    return texpath
+TEMPLATE = 'document.tex'
+DOC_WORKERS = 4
+STAMP_FILE = 'document.stamp'
+LATEX_CMD = ['pdflatex', '-interaction=nonstopmode', '-halt-on-error',
+             'document.tex']
+INCLUDE_RE = re.compile(r'\\includegraphics(?:\[[^\]]*\])?\{([^}]+)\}')
+# 'latex' builds from the figure files with pdflatex, 'native' writes the
+# pages straight from the matplotlib figures (see native_document)
+BACKENDS = ('latex', 'native')
+# figures of the native report, in the page order of document.tex
+PAGES = ['ba_slope_hist', 'ba_slope', 'ba', 'slope', 'contour', 'naip']
+
+
+def doc_path(figdir):
+    apn = os.path.basename(os.path.normpath(figdir))
+    return os.path.normpath(f'{figdir}/../../doc/{apn}.pdf')
+
+
+def template_figures(template=TEMPLATE):
+    """
+    File names of the figures included by the template
+    """
+    with open(template) as f:
+        return INCLUDE_RE.findall(f.read())
+
+
+def fingerprint(figdir, template=TEMPLATE, template_digest=None):
+    """
+    sha256 over the template and every figure it includes, a missing
+    figure counts as its own state
+    """
+    sha = hashlib.sha256()
+    sha.update((template_digest or cache.file_digest(template)).encode())
+    for name in template_figures(template):
+        path = os.path.join(figdir, name)
+        digest = cache.file_digest(path) if os.path.exists(path) else 'missing'
+        sha.update(f'{name}:{digest}'.encode())
+    return sha.hexdigest()
+
+
+def is_current(figdir, stamp):
+    stamp_file = os.path.join(figdir, STAMP_FILE)
+    if not (os.path.exists(stamp_file) and os.path.exists(doc_path(figdir))):
+        return False
+    with open(stamp_file) as f:
+        return json.load(f).get('fingerprint') == stamp
+
+
+def write_stamp(figdir, stamp):
+    stamp_file = os.path.join(figdir, STAMP_FILE)
+    tmp_file = reutil.atomic_path(stamp_file)
+    with open(tmp_file, 'w') as f:
+        json.dump({'fingerprint': stamp}, f)
+    os.replace(tmp_file, stamp_file)
+
+
+def make_document(figdir, template=TEMPLATE, force=False, template_digest=None):
+    """
+    Build the parcel pdf in a private temporary directory, so builds of
+    different parcels never share a working directory. Skipped when the
+    template and the figures are unchanged since the last build.
+    """
+    apn = os.path.basename(os.path.normpath(figdir))
+    with instrument.span('make_document', apn=apn):
+        return _make_document(figdir, template, force, template_digest)
+
+
+def _make_document(figdir, template, force, template_digest):
+    outfile = doc_path(figdir)
+    stamp = fingerprint(figdir, template, template_digest)
+    if not force and is_current(figdir, stamp):
+        print(f'{outfile} is up to date, skipping build...')
+        return outfile
+
+    with tempfile.TemporaryDirectory(prefix='document_') as builddir:
+        shutil.copy(template, os.path.join(builddir, 'document.tex'))
+        for name in template_figures(template):
+            path = os.path.join(figdir, name)
+            if os.path.exists(path):
+                os.symlink(os.path.abspath(path), os.path.join(builddir, name))
+        call = subprocess.run(LATEX_CMD,
+                              cwd=builddir,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              text=True)
+        if call.returncode != 0:
+            raise RuntimeError(f'pdflatex failed for {figdir}:\n'
+                               + '\n'.join(call.stdout.splitlines()[-20:]))
+
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        tmp_file = reutil.atomic_path(outfile)
+        shutil.copy(os.path.join(builddir, 'document.pdf'), tmp_file)
+        os.replace(tmp_file, outfile)
+    write_stamp(figdir, stamp)
+    return outfile
+
+
+def make_documents(figdirs, workers=DOC_WORKERS, template=TEMPLATE, force=False):
+    """
+    Build the documents of several parcels, at most workers pdflatex
+    processes at a time. Returns the pdf paths in the order of figdirs.
+    """
+    # hashed once here rather than by every build thread
+    template_digest = cache.file_digest(template)
+    if workers <= 1:
+        return [make_document(figdir, template=template, force=force,
+                              template_digest=template_digest)
+                for figdir in figdirs]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(make_document, figdir, template=template,
+                               force=force, template_digest=template_digest)
+                   for figdir in figdirs]
+        return [future.result() for future in futures]
+
+
+@contextlib.contextmanager
+def native_document(figdir, write_figures=True):
+    """
+    Parcel pdf assembled from the figures drawn by plotting while the
+    context is open, one page per figure in PAGES, without pdflatex.
+    The figures must be drawn in this process and in page order.
+    write_figures=False also skips the png/pdf files of those figures.
+    """
+    from matplotlib.backends.backend_pdf import PdfPages
+    import plotting
+
+    outfile = doc_path(figdir)
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    tmp_file = reutil.atomic_path(outfile)
+    try:
+        with PdfPages(tmp_file) as pdf:
+            with plotting.report(pdf, PAGES, write_files=write_figures) as done:
+                yield outfile
+        if done != PAGES:
+            raise RuntimeError(f'{figdir}: report is missing pages '
+                               f'{[page for page in PAGES if page not in done]}')
+        os.replace(tmp_file, outfile)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    # the latex stamp no longer describes this pdf
+    stamp_file = os.path.join(figdir, STAMP_FILE)
+    if os.path.exists(stamp_file):
+        os.remove(stamp_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import concurrent.futures
+import boto3
+import botocore.config
+from boto3.s3.transfer import TransferConfig
+
+import utils as reutil
+import instrument
+
+NAIP_BUCKET = 'naip-source'
+DOWNLOAD_WORKERS = 8
+# point at a local s3 stand-in for testing
+S3_ENDPOINT = os.environ.get('NAIP_S3_ENDPOINT')
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=16 * 1024**2,
+                                 multipart_chunksize=16 * 1024**2,
+                                 max_concurrency=4)
+REQUEST_PAYER = {'RequestPayer': 'requester'}
+# seconds between checks on a download claimed by another process
+CLAIM_POLL = 0.5
+
+_lock = threading.Lock()
+_clients = {}
+_pool = None
+_inflight = {}
+
+
+def get_client(endpoint_url=S3_ENDPOINT):
+    """
+    One s3 client per endpoint, shared by all download threads
+    (boto3 clients are thread safe, sessions are not)
+    """
+    with _lock:
+        if endpoint_url not in _clients:
+            config = botocore.config.Config(
+                max_pool_connections=DOWNLOAD_WORKERS*TRANSFER_CONFIG.max_concurrency,
+                retries={'max_attempts': 5, 'mode': 'standard'},
+                # stand-ins are usually served from localhost
+                s3={'addressing_style': 'path'} if endpoint_url else None)
+            _clients[endpoint_url] = boto3.client(
+                's3', endpoint_url=endpoint_url, config=config)
+        return _clients[endpoint_url]
+
+
+def get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=DOWNLOAD_WORKERS)
+        return _pool
+
+
+def meta_path(outfile):
+    return f'{outfile}.s3.json'
+
+
+def write_meta(outfile, size, etag):
+    meta_file = meta_path(outfile)
+    tmp_file = reutil.atomic_path(meta_file)
+    with open(tmp_file, 'w') as f:
+        json.dump({'size': size, 'etag': etag}, f)
+    os.replace(tmp_file, meta_file)
+
+
+def is_cached(outfile):
+    """
+    A cached file is trusted when its size matches the size recorded when
+    it was verified, no need to open it in rasterio
+    """
+    meta_file = meta_path(outfile)
+    if not (os.path.exists(outfile) and os.path.exists(meta_file)):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    return os.path.getsize(outfile) == meta['size']
+
+
+def lock_path(outfile):
+    return f'{outfile}.lock'
+
+
+def owner_alive(lock_file):
+    """
+    False only if the process that wrote lock_file is known to be gone
+    """
+    try:
+        with open(lock_file) as f:
+            pid = int(f.read())
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # created but the pid is not written yet
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def claim(outfile):
+    """
+    True if this process now owns the download of outfile, False if
+    another process (or thread) does. The claim is a lock file next to
+    outfile created with O_EXCL, so it holds across the parcel workers;
+    a claim left behind by a dead process is taken over.
+    """
+    lock_file = lock_path(outfile)
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if owner_alive(lock_file):
+            return False
+        try:
+            os.remove(lock_file)
+        except FileNotFoundError:
+            pass
+        return claim(outfile)
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def fetch(key, outfile, bucket=NAIP_BUCKET, replace=False, endpoint_url=S3_ENDPOINT):
+    """
+    Download s3://bucket/key to outfile through a temp file, verified
+    against the object size and (for single part uploads) the md5 etag.
+    Only one process downloads outfile at a time, the others wait for it
+    and use its file.
+    """
+    if not replace and is_cached(outfile):
+        print(outfile + ' exists')
+        return outfile
+
+    os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+    while not claim(outfile):
+        time.sleep(CLAIM_POLL)
+    try:
+        # the previous owner of the claim may have just finished it
+        if not replace and is_cached(outfile):
+            print(outfile + ' exists')
+            return outfile
+        return download(key, outfile, bucket=bucket, replace=replace,
+                        endpoint_url=endpoint_url)
+    finally:
+        os.remove(lock_path(outfile))
+
+
+def download(key, outfile, bucket=NAIP_BUCKET, replace=False, endpoint_url=S3_ENDPOINT):
+    """
+    fetch without the cache check and claim, call it only while holding
+    the claim on outfile
+    """
+    client = get_client(endpoint_url)
+    head = client.head_object(Bucket=bucket, Key=key, **REQUEST_PAYER)
+    size = head['ContentLength']
+    etag = head['ETag'].strip('"')
+
+    if not replace and os.path.exists(outfile) and os.path.getsize(outfile) == size:
+        # complete file from before the size records existed
+        write_meta(outfile, size, etag)
+        print(outfile + ' exists')
+        return outfile
+
+    print("downloading naip file "+outfile)
+    tmp_file = reutil.atomic_path(outfile)
+    try:
+        client.download_file(bucket, key, tmp_file, ExtraArgs=REQUEST_PAYER,
+                             Config=TRANSFER_CONFIG)
+        if os.path.getsize(tmp_file) != size:
+            raise IOError(f'{key}: got {os.path.getsize(tmp_file)} bytes, expected {size}')
+        # multipart etags are not an md5 of the content
+        if '-' not in etag and md5sum(tmp_file) != etag:
+            raise IOError(f'{key}: md5 does not match etag {etag}')
+        os.replace(tmp_file, outfile)
+        instrument.count('downloaded', size)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    write_meta(outfile, size, etag)
+    return outfile
+
+
+def submit(key, outfile, bucket=NAIP_BUCKET, replace=False, endpoint_url=S3_ENDPOINT):
+    """
+    Future for the download of key. Requests for a key that is already
+    being downloaded share the running future instead of racing on it.
+    """
+    pool = get_pool()
+    with _lock:
+        future = _inflight.get((bucket, key))
+        if future is None or future.done():
+            future = pool.submit(fetch, key, outfile, bucket=bucket,
+                                 replace=replace, endpoint_url=endpoint_url)
+            _inflight[(bucket, key)] = future
+    return future
+
+
+def download_many(keys, download_dir, bucket=NAIP_BUCKET, replace=False,
+                  endpoint_url=S3_ENDPOINT):
+    """
+    Download keys concurrently into download_dir, returns local paths in
+    the order of keys
+    """
+    futures = [submit(key, os.path.join(download_dir, os.path.basename(key)),
+                      bucket=bucket, replace=replace, endpoint_url=endpoint_url)
+               for key in keys]
+    return [future.result() for future in futures]
@@ -2,18 +2,78 @@ import os
 import pandas as pd
 import geopandas as gp
 import numpy as np
+import json
 import folium
+import shapely.ops
+import shapely.geometry
+
 import utils
-import rasterio
-import pyproj
-from shapely.geometry import box
-import matplotlib.cm as cm
+import tiles
+
+BA_FILE = "../data/ca3987612137920210714_20201012_20211015_ravg_data/ca3987612137920210714_20201012_20211015_rdnbr_ba.tif"
+MAP_FILE = '../map.html'
+CROP_BUFFER = 20000  # meters of BA shown around the parcels
+UTM_CRS = 'epsg:32610'
+SIMPLIFY_M = 1.0  # parcel outlines simplified to within a meter
+PRECISION = 6  # decimal degrees, ~0.1 m
+# above this many parcels the layer is a geojson file next to the map,
+# loaded by the page, instead of being inlined in map.html
+SIDECAR_MIN = 500
+
+
+def parcel_features(gdf, include_pdf=False, tolerance=SIMPLIFY_M,
+                    precision=PRECISION):
+    """
+    One FeatureCollection of the parcels, simplified in meters and with
+    coordinates rounded to precision decimals
+    """
+    geoms = gdf.geometry.to_crs(UTM_CRS).simplify(tolerance, preserve_topology=True)
+    geoms = [shapely.ops.transform(
+        lambda x, y: (np.round(x, precision), np.round(y, precision)), geom)
+        for geom in geoms.to_crs('epsg:4326')]
+    names = gdf['Name'].astype(str).to_list()
+    if include_pdf:
+        labels = [f"<a href = 'doc/{name}.pdf'> {name}</a>" for name in names]
+    else:
+        labels = names
+    features = [{'type': 'Feature',
+                 'properties': {'Name': name, 'label': label},
+                 'geometry': shapely.geometry.mapping(geom)}
+                for name, label, geom in zip(names, labels, geoms)]
+    return {'type': 'FeatureCollection', 'features': features}
 
 
-def warner(gdf, crop=True, include_pdf=False):
+def parcel_layer(gdf, include_pdf=False, outfile=MAP_FILE, sidecar_min=SIDECAR_MIN):
+    """
+    All parcels as one GeoJson layer with a popup per feature
+    """
+    collection = parcel_features(gdf, include_pdf=include_pdf)
+    style = {'fillColor': 'white'}
+    popup = folium.GeoJsonPopup(fields=['label'], labels=False)
+    layer = folium.GeoJson(data=collection, name='Parcels',
+                           style_function=lambda x: style, popup=popup)
+    if len(collection['features']) < sidecar_min:
+        return layer
+
+    map_dir = os.path.dirname(outfile) or '.'
+    parcel_file = os.path.join(map_dir, 'parcels.geojson')
+    tmp_file = utils.atomic_path(parcel_file)
+    with open(tmp_file, 'w') as f:
+        # layer.data, as folium may have added feature ids to it
+        json.dump(layer.data, f, separators=(',', ':'))
+    os.replace(tmp_file, parcel_file)
+    # the page fetches the sidecar, relative to the map, instead of
+    # embedding the features
+    layer.embed = False
+    layer.embed_link = os.path.basename(parcel_file)
+    return layer
+
+
+def warner(gdf, crop=True, include_pdf=False, ba_file=BA_FILE, outfile=MAP_FILE,
+           tile_dir=tiles.TILE_DIR):
     m = folium.Map(location=[40.419097, -121.330998],
                    zoom_start=14, tiles='CartoDB positron')
-    tiles = folium.TileLayer(
+    satellite = folium.TileLayer(
         tiles="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
         attr='Google',
         name='Google Satellite',
@@ -22,47 +82,29 @@ def warner(gdf, crop=True, include_pdf=False):
         opacity=1,
     ).add_to(m)
 
-    for _, r in gdf.iterrows():
-        sim_geo = gp.GeoSeries(r['geometry'])  # .simplify(tolerance=0.001)
-        geo_j = sim_geo.to_json()
-        geo_j = folium.GeoJson(data=geo_j,
-                               style_function=lambda x: {'fillColor': 'white'})
-        if include_pdf:
-            folium.Popup(
-                f"<a href = 'doc/{r.Name}.pdf'> {r.Name}</a>").add_to(geo_j)
-        else:
-            folium.Popup(
-                f"{r.Name}").add_to(geo_j)
-        geo_j.add_to(m)
+    parcel_layer(gdf, include_pdf=include_pdf, outfile=outfile).add_to(m)
 
-    ba_file = "../data/ca3987612137920210714_20201012_20211015_ravg_data/ca3987612137920210714_20201012_20211015_rdnbr_ba.tif"
-    mer_file = f"/tmp/{os.path.basename(ba_file)}"
-    web_crs = "epsg:3857"
-    utils.geotiff_to_utm(ba_file, mer_file, dst_crs=web_crs)
+    # BA as a local tile pyramid next to the map, tiles that are up to
+    # date are reused
     if crop:
-        crop_file = mer_file.replace('.tif', '_projected.tif')
-        aoi = gdf.to_crs(web_crs).unary_union
-        utils.crop_to_aoi(
-            mer_file, [box(*aoi.buffer(20000).bounds)], crop_file, nodata=255)
+        # same box as buffering the union, without building it
+        xmin, ymin, xmax, ymax = gdf.to_crs(tiles.WEB_CRS).total_bounds
+        bounds = (xmin-CROP_BUFFER, ymin-CROP_BUFFER,
+                  xmax+CROP_BUFFER, ymax+CROP_BUFFER)
     else:
-        crop_file = mer_file
-    with rasterio.open(crop_file) as src:
-        dataimage = src.read(1)
-        dataimage[dataimage < 0] = 0
-        dataimage[dataimage == 255] = 0
-        dataimage = dataimage/255
-        bounds = src.bounds
-    proj = pyproj.Transformer.from_crs(3857, 4326, always_xy=True)
-    xmin, ymin = proj.transform(bounds[0], bounds[1])
-    xmax, ymax = proj.transform(bounds[2], bounds[3])
-
-    folium.raster_layers.ImageOverlay(
-        image=dataimage,
-        bounds=[[ymin, xmin], [ymax, xmax]],
+        bounds = None
+    url = tiles.render_tiles(ba_file, 'ba', bounds=bounds, tile_dir=tile_dir)
+    folium.TileLayer(
+        tiles=os.path.relpath(url, os.path.dirname(outfile) or '.'),
+        attr='RAVG',
+        name='Burned area',
+        overlay=True,
+        control=True,
         opacity=0.6,
-        colormap=cm.get_cmap('hot'),
+        max_native_zoom=tiles.MAX_ZOOM,
+        max_zoom=20,
     ).add_to(m)
-    m.save('../map.html')
+    m.save(outfile)
 
 
 if __name__ == "__main__":
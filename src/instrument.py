@@ -0,0 +1,219 @@
+"""
+Stage spans for the per parcel pipeline.
+
+    with instrument.span('dem'):
+        ...
+
+records wall and cpu seconds, the change in peak rss, bytes read and
+written by the process (/proc/self/io, linux), bytes downloaded (see
+count) and optionally the tracemalloc peak, tagged with the current apn.
+Spans are appended to one file as json lines, or as chrome trace events
+(load in chrome://tracing or perfetto). One stage can be run under
+cProfile.
+
+Disabled (the default), span() returns one shared no-op context manager
+and count() returns at once. The settings are kept in the environment so
+worker processes pick them up.
+"""
+import os
+import json
+import time
+import resource
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+ENV_FILE = 'WARNER_TRACE_FILE'
+ENV_FORMAT = 'WARNER_TRACE_FORMAT'
+ENV_TRACEMALLOC = 'WARNER_TRACE_TRACEMALLOC'
+ENV_PROFILE = 'WARNER_PROFILE_STAGE'
+FORMATS = ('jsonl', 'chrome')
+PROFILE_DIR = '../profiles/'
+
+TRACE_FILE = None
+TRACE_FORMAT = 'jsonl'
+PROFILE_STAGE = None
+ENABLED = False
+
+_NULL = contextlib.nullcontext()
+_CONTEXT = {}
+_COUNTERS = {'downloaded': 0}
+_lock = threading.Lock()
+# tracemalloc peaks of the open spans of each thread, outermost first
+_peaks = threading.local()
+
+
+def configure(trace_file=None, trace_format='jsonl', tracemalloc_on=False,
+              profile_stage=None):
+    """
+    Turn instrumentation on (trace_file given) or off, for this process
+    and the processes it starts
+    """
+    global TRACE_FILE, TRACE_FORMAT, PROFILE_STAGE, ENABLED
+    if trace_format not in FORMATS:
+        raise ValueError(f'trace_format must be one of {FORMATS}')
+    TRACE_FILE = os.path.abspath(trace_file) if trace_file else None
+    TRACE_FORMAT = trace_format
+    PROFILE_STAGE = profile_stage
+    ENABLED = TRACE_FILE is not None
+
+    for key, value in [(ENV_FILE, TRACE_FILE), (ENV_FORMAT, trace_format),
+                       (ENV_TRACEMALLOC, '1' if tracemalloc_on else None),
+                       (ENV_PROFILE, profile_stage)]:
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+    if not ENABLED:
+        return
+    if tracemalloc_on and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if TRACE_FORMAT == 'chrome' and not os.path.exists(TRACE_FILE):
+        # the closing bracket is optional in the trace event format, so
+        # events can be appended by any number of processes
+        with open(TRACE_FILE, 'w') as f:
+            f.write('[\n')
+
+
+def configure_from_env():
+    if os.environ.get(ENV_FILE):
+        configure(os.environ[ENV_FILE], os.environ.get(ENV_FORMAT, 'jsonl'),
+                  tracemalloc_on=bool(os.environ.get(ENV_TRACEMALLOC)),
+                  profile_stage=os.environ.get(ENV_PROFILE))
+
+
+def set_context(**tags):
+    """
+    Tags (e.g. apn) added to every following span of this process
+    """
+    _CONTEXT.clear()
+    _CONTEXT.update(tags)
+
+
+def count(name, n):
+    if not ENABLED:
+        return
+    with _lock:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+
+def read_proc_io():
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+    except OSError:
+        return {}
+    return {'read_bytes': int(fields['read_bytes']),
+            'write_bytes': int(fields['write_bytes'])}
+
+
+def snapshot():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    snap = {'wall': time.perf_counter(), 'cpu': time.process_time(),
+            'maxrss_kb': usage.ru_maxrss, 'downloaded': _COUNTERS['downloaded']}
+    snap.update(read_proc_io())
+    return snap
+
+
+def span(stage, **tags):
+    """
+    Context manager recording one stage, a shared no-op when disabled
+    """
+    if not ENABLED:
+        return _NULL
+    return _span(stage, tags)
+
+
+def peak_enter():
+    """
+    Start a span's tracemalloc peak. The peak so far is kept for the
+    enclosing span before it is reset, so resetting for a nested span
+    does not lose the outer span's peak.
+    """
+    stack = _peaks.__dict__.setdefault('stack', [])
+    if not tracemalloc.is_tracing():
+        stack.append(None)
+        return
+    if hasattr(tracemalloc, 'reset_peak'):
+        if stack and stack[-1] is not None:
+            stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    stack.append(0)
+
+
+def peak_exit():
+    """
+    tracemalloc peak of the span being closed, None when not tracing. It
+    also counts towards the enclosing span's peak.
+    """
+    peak = _peaks.stack.pop()
+    if peak is None or not tracemalloc.is_tracing():
+        return None
+    peak = max(peak, tracemalloc.get_traced_memory()[1])
+    if _peaks.stack and _peaks.stack[-1] is not None:
+        _peaks.stack[-1] = max(_peaks.stack[-1], peak)
+    return peak
+
+
+@contextlib.contextmanager
+def _span(stage, tags):
+    tags = dict(_CONTEXT, **tags)
+    profiler = cProfile.Profile() if stage == PROFILE_STAGE else None
+    peak_enter()
+    start_time = time.time()
+    before = snapshot()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        after = snapshot()
+        record = dict(tags, stage=stage, start=start_time, pid=os.getpid(),
+                      wall=round(after['wall'] - before['wall'], 6),
+                      cpu=round(after['cpu'] - before['cpu'], 6),
+                      maxrss_kb=after['maxrss_kb'],
+                      maxrss_delta_kb=after['maxrss_kb'] - before['maxrss_kb'],
+                      downloaded_bytes=after['downloaded'] - before['downloaded'])
+        for key in ['read_bytes', 'write_bytes']:
+            if key in after:
+                record[key] = after[key] - before[key]
+        peak = peak_exit()
+        if peak is not None:
+            record['tracemalloc_peak'] = peak
+        if profiler is not None:
+            record['profile'] = dump_profile(profiler, stage, tags)
+        emit(record)
+
+
+def dump_profile(profiler, stage, tags):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = '_'.join(str(v) for v in tags.values()) or str(os.getpid())
+    path = os.path.abspath(os.path.join(PROFILE_DIR, f'{name}_{stage}.prof'))
+    profiler.dump_stats(path)
+    return path
+
+
+def emit(record):
+    if TRACE_FORMAT == 'chrome':
+        args = {k: v for k, v in record.items()
+                if k not in ('stage', 'start', 'wall', 'pid')}
+        event = {'name': record['stage'], 'ph': 'X', 'pid': record['pid'],
+                 'tid': threading.get_ident() % 2**31,
+                 'ts': int(record['start']*1e6), 'dur': int(record['wall']*1e6),
+                 'args': args}
+        line = json.dumps(event) + ',\n'
+    else:
+        line = json.dumps(record) + '\n'
+    # one write per record on an O_APPEND file, so processes do not interleave
+    with _lock:
+        fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+
+configure_from_env()
@@ -1,38 +1,95 @@
-import boto3
 import os
+import math
 import pandas as pd
 import rasterio
-from rasterio.merge import merge
+import rasterio.windows
+from rasterio.transform import Affine
 import json
 import pyproj
 import numpy as np
 import shapely
 import shapely.geometry
+import shapely.prepared
+import shapely.wkb
 import numbers
+import sqlite3
 import rtree
 import geopandas as gp
 
 import utils as reutil
+import downloader
+import cache
+import run_manifest
 
 HOME = os.path.expanduser("~")
 NAIP_DIR = f'{HOME}/data//NAIP/'
 LOCAL_DIR = '../data/NAIP/'
+MANIFEST_DB = f'{LOCAL_DIR}/manifest.sqlite'
+USGS_TOPO_FILE = os.path.join(LOCAL_DIR, 'usgs_topo_quads.geojson')
+USGS_TOPO_INDEX = os.path.join(LOCAL_DIR, 'usgs_topo_quads_rtree')
+MERGE_BLOCK_SIZE = 4096
 
 
-def project_coords(coords, from_proj, to_proj):
+_TRANSFORMERS = {}
+
+
+def get_transformer(from_proj, to_proj):
+    """
+    One pyproj Transformer per crs pair for the life of the process
+    """
+    key = (str(from_proj), str(to_proj))
+    if key not in _TRANSFORMERS:
+        _TRANSFORMERS[key] = pyproj.Transformer.from_proj(from_proj, to_proj)
+    return _TRANSFORMERS[key]
+
+
+def flatten_coords(coords, points, offsets):
+    """
+    Collect the rings / lines of a nested geojson coordinate array as numpy
+    blocks into points, recording each block length in offsets. Returns a
+    template of the nesting to rebuild from.
+    """
     if len(coords) < 1:
         return []
-
     if isinstance(coords[0], numbers.Number):
-        from_x, from_y = coords[0], coords[1]
-        trans = pyproj.Transformer.from_proj(from_proj, to_proj)
-        to_x, to_y = trans.transform(from_y, from_x)
-        return [to_x, to_y]
+        # a single position
+        points.append(np.asarray([coords[:2]], dtype=float))
+        offsets.append(1)
+        return 'point'
+    if all(len(c) and isinstance(c[0], numbers.Number) for c in coords):
+        # a sequence of positions, one numpy block per ring (empty parts
+        # fall through to the element wise case and stay empty)
+        block = np.asarray([c[:2] for c in coords], dtype=float)
+        points.append(block)
+        offsets.append(len(block))
+        return 'line'
+    return [flatten_coords(coord, points, offsets) for coord in coords]
+
+
+def rebuild_coords(template, blocks):
+    if template == 'point':
+        return next(blocks)[0].tolist()
+    if template == 'line':
+        return next(blocks).tolist()
+    return [rebuild_coords(t, blocks) for t in template]
+
+
+def project_coords(coords, from_proj, to_proj):
+    """
+    Project a nested geojson coordinate array in one transformer call
+    """
+    points, offsets = [], []
+    template = flatten_coords(coords, points, offsets)
+    if not points:
+        return template
 
-    new_coords = []
-    for coord in coords:
-        new_coords.append(project_coords(coord, from_proj, to_proj))
-    return new_coords
+    xy = np.concatenate(points)
+    trans = get_transformer(from_proj, to_proj)
+    # axis order as used throughout: input given as (y, x)
+    to_x, to_y = trans.transform(xy[:, 1], xy[:, 0])
+    projected = np.column_stack([to_x, to_y])
+    blocks = iter(np.split(projected, np.cumsum(offsets)[:-1]))
+    return rebuild_coords(template, blocks)
 
 
 def project_feature(feature, from_proj, to_proj):
@@ -48,33 +105,7 @@ def project_feature(feature, from_proj, to_proj):
 
 def download(address, replace=False, download_dir=NAIP_DIR):
     outfile = os.path.join(download_dir, os.path.basename(address))
-
-    if os.path.exists(outfile):
-        exists = True
-        try:
-            src = rasterio.open(outfile)
-            corrupt = False
-        except(rasterio.errors.RasterioIOError):
-            exists = False
-            corrupt = True
-    else:
-        exists = False
-        if not exists:
-            print("downloading naip file "+outfile)
-        elif exists and replace:
-            print("downloading naip file "+outfile)
-        elif corrupt:
-            print("downloading naip file "+outfile)
-        else:
-            print(outfile + ' exists')
-
-        def get(address, outfile):
-            s3_client = boto3.client('s3')
-            s3_client.download_file(
-                'naip-source', address, outfile, {'RequestPayer': 'requester'})
-
-        get(address, outfile)
-    return outfile
+    return downloader.fetch(address, outfile, replace=replace)
 
 
 def parse_aws_naip_manifest(manifest_file=f'{LOCAL_DIR}/manifest.txt'):
@@ -101,14 +132,185 @@ def parse_aws_naip_manifest(manifest_file=f'{LOCAL_DIR}/manifest.txt'):
     return df
 
 
-def sjoin(shape1, shape2):
-    tree_idx = rtree.index.Index()
-    for i, shp in enumerate(shape1['features']):
-        shp_shp = shapely.geometry.shape(shp['geometry'])
-        tree_idx.insert(i, (shp_shp.bounds), obj=shp['properties'])
-    match = tree_idx.intersection(
-        shapely.geometry.shape(shape2[0]['geometry']).bounds, objects=True)
-    return [f.object for f in match]
+def build_manifest_db(manifest_file=f'{LOCAL_DIR}/manifest.txt',
+                      db_file=MANIFEST_DB):
+    """
+    One time conversion of manifest.txt into an sqlite table indexed on
+    (state, quad, type, year), so per parcel lookups do not have to parse
+    the multi-million line manifest.
+    """
+    print(f'building naip manifest store {db_file}')
+    tmp_file = reutil.atomic_path(db_file)
+    con = sqlite3.connect(tmp_file)
+    con.execute("""CREATE TABLE manifest (
+                   state TEXT, year INTEGER, res TEXT, type TEXT,
+                   quad TEXT, filename TEXT, date TEXT, fullpath TEXT)""")
+
+    def rows():
+        with open(manifest_file) as f:
+            for line in f:
+                fullpath = line.strip()
+                parts = fullpath.split('/')
+                # same rows parse_aws_naip_manifest keeps
+                if len(parts) < 6 or not parts[5]:
+                    continue
+                state, year, res, typ, quad, filename = parts[:6]
+                date = os.path.splitext(filename)[0][-8:]
+                year = int(year) if year.isdigit() else None
+                yield (state, year, res, typ, quad, filename, date, fullpath)
+
+    con.executemany('INSERT INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    rows())
+    con.execute('CREATE INDEX manifest_idx ON manifest (state, quad, type, year)')
+    con.commit()
+    con.close()
+    os.replace(tmp_file, db_file)
+    return db_file
+
+
+def manifest_db(manifest_file=f'{LOCAL_DIR}/manifest.txt', db_file=MANIFEST_DB):
+    """
+    Path to the manifest store, (re)built if missing or older than manifest.txt
+    """
+    if (not os.path.exists(db_file) or
+            os.path.getmtime(db_file) < os.path.getmtime(manifest_file)):
+        build_manifest_db(manifest_file, db_file)
+    return db_file
+
+
+def query_manifest(state, quad, quad_num, typ='rgbir', db_file=MANIFEST_DB):
+    """
+    Rows of the manifest for one quarter quad, most recent year first.
+    Same columns as parse_aws_naip_manifest.
+    """
+    con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    df = pd.read_sql_query(
+        """SELECT state AS State, year AS Year, res AS Res, type AS Type,
+                  quad AS Quad, filename AS Filename, date AS Date,
+                  fullpath AS Fullpath
+           FROM manifest
+           WHERE state = ? AND quad = ? AND type = ? AND instr(filename, ?) > 0
+           ORDER BY year DESC, rowid""",
+        con, params=(state, quad, typ, quad_num))
+    con.close()
+    return df
+
+
+def build_topo_index(usgs_shapefile=USGS_TOPO_FILE, index_base=USGS_TOPO_INDEX):
+    """
+    Bulk load the usgs topo quads into an on-disk rtree. Each entry carries
+    the quad properties and its exact geometry as wkb.
+    """
+    print(f'building topo quad index {index_base}')
+    with open(usgs_shapefile) as f:
+        usgs_polys = json.load(f)
+
+    def items():
+        for i, shp in enumerate(usgs_polys['features']):
+            shp_shp = shapely.geometry.shape(shp['geometry'])
+            yield (i, shp_shp.bounds, (shp['properties'], shp_shp.wkb))
+
+    tmp_base = reutil.atomic_path(index_base)
+    tree_idx = rtree.index.Index(tmp_base, items())
+    tree_idx.close()
+    with open(f'{tmp_base}.crs', 'w') as f:
+        f.write(usgs_polys['crs']['properties']['name'])
+    for ext in ['idx', 'dat', 'crs']:
+        os.replace(f'{tmp_base}.{ext}', f'{index_base}.{ext}')
+    return index_base
+
+
+def topo_index(usgs_shapefile=USGS_TOPO_FILE, index_base=USGS_TOPO_INDEX):
+    """
+    Base path of the topo quad index, (re)built if missing or older than
+    the quads file
+    """
+    if (not os.path.exists(f'{index_base}.idx') or
+            os.path.getmtime(f'{index_base}.idx') < os.path.getmtime(usgs_shapefile)):
+        build_topo_index(usgs_shapefile, index_base)
+    return index_base
+
+
+def prepare(manifest_file=f'{LOCAL_DIR}/manifest.txt', db_file=MANIFEST_DB,
+            usgs_shapefile=USGS_TOPO_FILE, index_base=USGS_TOPO_INDEX):
+    """
+    Build the manifest store and the topo quad index if needed. Run once
+    before parcels go to worker processes, which would otherwise all
+    build them at the same time.
+    """
+    return (manifest_db(manifest_file, db_file),
+            topo_index(usgs_shapefile, index_base))
+
+
+_TOPO_INDEX = {}
+
+
+def load_topo_index(usgs_shapefile=USGS_TOPO_FILE, index_base=USGS_TOPO_INDEX):
+    """
+    (rtree index, crs) of the topo quads, built on first use and kept open
+    for the life of the process
+    """
+    if index_base in _TOPO_INDEX:
+        return _TOPO_INDEX[index_base]
+    topo_index(usgs_shapefile, index_base)
+    with open(f'{index_base}.crs') as f:
+        usgs_crs = pyproj.crs.CRS(f.read())
+    _TOPO_INDEX[index_base] = (rtree.index.Index(index_base), usgs_crs)
+    return _TOPO_INDEX[index_base]
+
+
+def add_quad_num(qd_id):
+    qd_id_key = qd_id[-2:]
+    alpha_num = {'A': 0, 'B': 1, 'C': 2,
+                 'D': 3, 'E': 4, 'F': 5, 'G': 6, 'H': 7}
+    # qd_id is grid is 8x8 with A1 in SE naip has 0 at NW (and 1-64)
+    qd = qd_id[:-3]
+    qd_num = qd+str((64-(alpha_num[qd_id_key[0]]*8) -
+                     int(qd_id_key[1])+1)).zfill(2)
+    return qd_num
+
+
+def quad_record(props):
+    out = dict(props)
+    out['state_abbr'] = state_to_abbr(out['ST_NAME1'])
+    out['naip_quad_num'] = add_quad_num(out['USGS_QD_ID'])
+    return out
+
+
+def match_quads(geoms, tree_idx):
+    """
+    Ids and properties of quads intersecting any of geoms (in the crs of
+    the index), exact geometry test after the bbox query
+    """
+    matched = {}
+    for geom in geoms:
+        prepared = shapely.prepared.prep(geom)
+        for item in tree_idx.intersection(geom.bounds, objects=True):
+            props, wkb = item.object
+            if item.id not in matched and prepared.intersects(shapely.wkb.loads(wkb)):
+                matched[item.id] = props
+    return [matched[k] for k in sorted(matched)]
+
+
+def match_quads_bulk(geoms, tree_idx):
+    """
+    match_quads of each of geoms (a GeoSeries in the crs of the index), in
+    order: one bbox query of the index for all of them, then one bulk
+    intersects of the geoms against the candidate quads
+    """
+    matched = [[] for _ in range(len(geoms))]
+    if len(geoms) == 0:
+        return matched
+    items = list(tree_idx.intersection(tuple(geoms.total_bounds), objects=True))
+    if not items:
+        return matched
+    quads = gp.GeoSeries([shapely.wkb.loads(item.object[1]) for item in items])
+    # query_bulk became sindex.query with array input in later geopandas
+    query = getattr(quads.sindex, 'query_bulk', quads.sindex.query)
+    geom_idx, quad_idx = query(geoms.values, predicate='intersects')
+    for i, j in sorted(zip(geom_idx, quad_idx), key=lambda ij: (ij[0], items[ij[1]].id)):
+        matched[i].append(items[j].object[0])
+    return matched
 
 
 def get_usgs_topo_quad(shape):
@@ -116,43 +318,37 @@ def get_usgs_topo_quad(shape):
     Look at shapefile to get quad
     https://www.arcgis.com/home/item.html?id=4bf2616d2f054fbe92eadcdc9582a765
     """
-    usgs_shapefile = os.path.join(LOCAL_DIR, 'usgs_topo_quads.geojson')
-    with open(usgs_shapefile) as f:
-        usgs_polys = json.load(f)
-    usgs_crs = pyproj.crs.CRS(usgs_polys['crs']['properties']['name'])
+    tree_idx, usgs_crs = load_topo_index()
 
     # project shape to crs of usgs
     shape_crs = pyproj.crs.CRS(shape['crs']['properties']['name'])
     new_shape = [project_feature(shp, shape_crs, usgs_crs)
                  for shp in shape['features']]
-    merged = sjoin(usgs_polys, new_shape)
-
-    def add_quad_num(qd_id):
-        qd_id_key = qd_id[-2:]
-        alpha_num = {'A': 0, 'B': 1, 'C': 2,
-                     'D': 3, 'E': 4, 'F': 5, 'G': 6, 'H': 7}
-        # qd_id is grid is 8x8 with A1 in SE naip has 0 at NW (and 1-64)
-        qd = qd_id[:-3]
-        qd_num = qd+str((64-(alpha_num[qd_id_key[0]]*8) -
-                         int(qd_id_key[1])+1)).zfill(2)
-        return qd_num
-    out = []
-    for mm in merged:
-        mm['state_abbr'] = state_to_abbr(mm['ST_NAME1'])
-        mm['naip_quad_num'] = add_quad_num(mm['USGS_QD_ID'])
-        out.append(mm)
-    return out
+    geoms = [shapely.geometry.shape(shp['geometry']) for shp in new_shape]
+    return [quad_record(mm) for mm in match_quads(geoms, tree_idx)]
+
+
+def get_usgs_topo_quads(gdf):
+    """
+    Bulk version of get_usgs_topo_quad. Resolves the quads of every row of
+    a GeoDataFrame with one projection and one pass over the index.
+    Returns a list of quad lists in row order.
+    """
+    tree_idx, usgs_crs = load_topo_index()
+    geoms = gdf.to_crs(usgs_crs).geometry
+    return [[quad_record(mm) for mm in matches]
+            for matches in match_quads_bulk(geoms, tree_idx)]
 
 
 def get_naip_quads(topo_quads, outfile_name=None, replace=False):
     """
     Downloads naip files containing dataframe
     """
-    mm = parse_aws_naip_manifest()
+    db_file = manifest_db()
 
     all_dates = ''
     all_quads = ''
-    out_files = []
+    keys = []
 
     for ind, row in enumerate(topo_quads):
         if isinstance(row['state_abbr'], str):
@@ -165,11 +361,8 @@ def get_naip_quads(topo_quads, outfile_name=None, replace=False):
         qd = qd_num[:-2]
 
         # now need to use the qd info to find the most recent address
-        qd_df = mm[(mm['State'] == state_abbr) & (mm['Quad'] == qd)]
-        qd_num_df = qd_df[qd_df.Filename.str.contains(qd_num)]
-
-        qd_rgbir_df = qd_num_df[qd_num_df['Type'] == 'rgbir']
-        qd_rgbir = qd_rgbir_df.sort_values('Year', ascending=False)
+        qd_rgbir = query_manifest(state_abbr, qd, qd_num, 'rgbir',
+                                  db_file=db_file)
 
         # get most recent 4 files
         n_qds = 0
@@ -186,9 +379,10 @@ def get_naip_quads(topo_quads, outfile_name=None, replace=False):
 
         all_dates += date+'_'
         all_quads += qd_num+'_'
+        keys.extend(files)
 
-        for ff in files:
-            out_files.append(download(ff, replace=replace))
+    # all quarter quads of the parcel download concurrently
+    out_files = downloader.download_many(keys, NAIP_DIR, replace=replace)
     str_out = f"{all_quads}_{all_dates}"
     return out_files, str_out
 
@@ -265,58 +459,185 @@ def shape_to_geojson(shapes, crs):
     return out
 
 
-def merge_rasters(files, outfile='test.tiff'):
+def merge_placement(src, out_trans, out_bounds):
+    """
+    (source window, mosaic window) of src on the mosaic grid, aligned the
+    way rasterio.merge.merge (after gdal_merge.py) does, None if src is
+    outside the mosaic
+    """
+    left, bottom, right, top = src.bounds
+    int_w, int_s = max(left, out_bounds[0]), max(bottom, out_bounds[1])
+    int_e, int_n = min(right, out_bounds[2]), min(top, out_bounds[3])
+    if int_w >= int_e or int_s >= int_n:
+        return None
+    src_window = rasterio.windows.from_bounds(int_w, int_s, int_e, int_n,
+                                              src.transform)
+    window = rasterio.windows.from_bounds(int_w, int_s, int_e, int_n, out_trans)
+    window = rasterio.windows.Window(
+        math.floor(window.col_off + 0.1), math.floor(window.row_off + 0.1),
+        math.floor(window.width + 0.5), math.floor(window.height + 0.5))
+    return src_window, window
+
 
+def read_placed(src, src_window, window, block):
+    """
+    Masked pixels of src that merge would place in the mosaic window
+    block, and their (row, col) offset in block. None if src does not
+    reach block.
+    """
+    r0 = max(block.row_off, window.row_off)
+    r1 = min(block.row_off + block.height, window.row_off + window.height)
+    c0 = max(block.col_off, window.col_off)
+    c1 = min(block.col_off + block.width, window.col_off + window.width)
+    if r0 >= r1 or c0 >= c1:
+        return None
+    offsets = (src_window.row_off, src_window.col_off)
+    same_grid = (np.allclose(offsets, np.round(offsets), atol=1e-6) and
+                 round(src_window.height) == window.height and
+                 round(src_window.width) == window.width)
+    if same_grid:
+        # pixels map one to one, read only the part inside block
+        data = src.read(masked=True, window=rasterio.windows.Window(
+            round(src_window.col_off) + c0 - window.col_off,
+            round(src_window.row_off) + r0 - window.row_off, c1 - c0, r1 - r0))
+    else:
+        # resampled onto the mosaic grid: read only the (fractional) part
+        # of src_window that scales to the block's rows and columns
+        row_scale = src_window.height / window.height
+        col_scale = src_window.width / window.width
+        sub_window = rasterio.windows.Window(
+            src_window.col_off + (c0 - window.col_off)*col_scale,
+            src_window.row_off + (r0 - window.row_off)*row_scale,
+            (c1 - c0)*col_scale, (r1 - r0)*row_scale)
+        data = src.read(masked=True, window=sub_window,
+                        out_shape=(src.count, r1 - r0, c1 - c0))
+    return data, (r0 - block.row_off, c0 - block.col_off)
+
+
+def merge_rasters(files, outfile='test.tiff', block_size=MERGE_BLOCK_SIZE):
+    """
+    Mosaic files into outfile one block_size x block_size window at a time,
+    so peak memory depends on the block size rather than the mosaic size.
+    Same grid, pixel placement and first-wins overlap rule as
+    rasterio.merge.merge: each source is placed on the mosaic grid once,
+    and every block copies its part of that placement.
+    """
     src_files_to_mosaic = []
     for fp in files:
         src = rasterio.open(fp)
         src_files_to_mosaic.append(src)
 
-    crs = src.crs
-    out_meta = src.meta.copy()
-    mosaic, out_trans = merge(src_files_to_mosaic)
+    first = src_files_to_mosaic[0]
+    crs = first.crs
+    out_meta = first.meta.copy()
+    nodata = 0 if first.nodata is None else first.nodata
+
+    # mosaic grid, as computed by rasterio.merge.merge
+    res = first.res
+    xs, ys = [], []
+    for src in src_files_to_mosaic:
+        left, bottom, right, top = src.bounds
+        xs.extend([left, right])
+        ys.extend([bottom, top])
+    dst_w, dst_s, dst_e, dst_n = min(xs), min(ys), max(xs), max(ys)
+    width = int(round((dst_e - dst_w) / res[0]))
+    height = int(round((dst_n - dst_s) / res[1]))
+    out_trans = Affine.translation(dst_w, dst_n) * Affine.scale(res[0], -res[1])
+    # place sources against the bounds of the rounded grid, not of their
+    # union, so a resampled source is not squeezed into a row or column
+    # the mosaic does not have
+    grid_bounds = rasterio.windows.bounds(
+        rasterio.windows.Window(0, 0, width, height), out_trans)
+    placements = [(src, merge_placement(src, out_trans, grid_bounds))
+                  for src in src_files_to_mosaic]
 
     # Update the metadata
     out_meta.update({"driver": "GTiff",
-                     "height": mosaic.shape[1],
-                     "width": mosaic.shape[2],
+                     "height": height,
+                     "width": width,
                      "transform": out_trans,
-                     "crs": crs})
-
-    with rasterio.open(outfile, "w", **out_meta) as dest:
-        dest.write(mosaic)
+                     "crs": crs,
+                     "tiled": True,
+                     "blockxsize": 512,
+                     "blockysize": 512,
+                     "compress": "deflate"})
+
+    tmp_file = reutil.atomic_path(outfile)
+    with rasterio.open(tmp_file, "w", **out_meta) as dest:
+        for row in range(0, height, block_size):
+            for col in range(0, width, block_size):
+                window = rasterio.windows.Window(
+                    col, row, min(block_size, width - col),
+                    min(block_size, height - row))
+                block = np.full((first.count, window.height, window.width),
+                                nodata, dtype=first.dtypes[0])
+                for src, placement in placements:
+                    if placement is None:
+                        continue
+                    placed = read_placed(src, *placement, window)
+                    if placed is None:
+                        continue
+                    data, (r, c) = placed
+                    region = block[:, r:r + data.shape[1], c:c + data.shape[2]]
+                    # first wins: only fill what is still nodata
+                    empty = np.isnan(region) if np.isnan(nodata) else region == nodata
+                    fill = empty & ~np.ma.getmaskarray(data)
+                    region[fill] = data.data[fill]
+                dest.write(block, window=window)
+    for src in src_files_to_mosaic:
+        src.close()
+    os.replace(tmp_file, outfile)
     return outfile
 
 
-def get_raster(gdf, check_utm=False):
-    files_out = []
-    for i, row in gdf.iterrows():
-        shapes = [row.geometry]
-        geojson = shape_to_geojson(shapes, crs='epsg:4326')
-        topo_quads = get_usgs_topo_quad(geojson)
+def get_sources(gdf):
+    """
+    (quad files, merged file) of each group of topo quads of gdf. A merged
+    file is remade when any of the quads it is made of changed.
+    """
+    sources = []
+    for topo_quads in get_usgs_topo_quads(gdf):
         files, str_out = get_naip_quads(topo_quads)
         merge_file = f"{os.path.dirname(files[0])}/{str_out}.tif"
-        utm_file = merge_file.replace('.tif', '_utm.tif')
-        if check_utm and os.path.exists(utm_file):
-            print('utm_file exists, skipping creation of merge file')
-        elif not os.path.exists(merge_file):
-            merge_rasters(files, merge_file)
-        files_out.append(merge_file)
-    return files_out
+        run_manifest.run_stage(
+            merge_file, 'merge',
+            {'files': [cache.file_digest(f) for f in files]},
+            lambda: merge_rasters(files, merge_file))
+        sources.append((files, merge_file))
+    return sources
 
 
-def get_masked_raster(gdf, dst_crs="epsg:32610", masked_file=None):
-    filename = get_raster(gdf, check_utm=True)[0]
-    file_utm = filename.replace('.tif', '_utm.tif')
+def source_digests(sources):
+    """
+    Digests of the quads and the merged file of each of get_sources, for
+    the fingerprints of work done on them
+    """
+    return [{'quads': [cache.file_digest(f) for f in files],
+             'mosaic': cache.file_digest(merge_file)}
+            for files, merge_file in sources]
+
+
+def get_raster(gdf):
+    return [merge_file for _, merge_file in get_sources(gdf)]
+
+
+def mask_raster(filename, gdf, dst_crs="epsg:32610", masked_file=None):
+    """
+    filename warped to dst_crs and masked to gdf. Warped on read, so only
+    the aoi window of the mosaic is touched.
+    """
     gdf_utm = gdf.to_crs(dst_crs)
     poly_utm = gdf_utm.unary_union
-    if not os.path.exists(file_utm):
-        reutil.geotiff_to_utm(filename, file_utm, dst_crs)
     masked_file = masked_file or filename.replace('.tif', '_masked.tif')
-    reutil.crop_to_aoi(file_utm, [poly_utm], masked_file, nodata=0)
+    reutil.warp_crop_to_aoi(filename, [poly_utm], masked_file, dst_crs,
+                            nodata=0)
     return masked_file
 
 
+def get_masked_raster(gdf, dst_crs="epsg:32610", masked_file=None):
+    return mask_raster(get_raster(gdf)[0], gdf, dst_crs, masked_file)
+
+
 if __name__ == "__main__":
 
     lat = 37.47085
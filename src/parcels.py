@@ -0,0 +1,42 @@
+import geopandas as gp
+
+PARCEL_FILE = '../data/plumas_parsels.geojson'
+# WATERSHED_FILE = "../data/warner_valley_bounds.geojson"
+WATERSHED_FILE = "../data/warner_watershed.geojson"
+# these overlap with 011100025
+OVERLAPPING = ['011100007', '011100008']
+
+
+def watershed_parcels(parcel_file=PARCEL_FILE, watershed_file=WATERSHED_FILE):
+    """
+    Parcels clipped to the watershed, plus the rest of the watershed as
+    'Warner_Watershed'
+    """
+    gdf = gp.read_file(parcel_file)
+    val = gp.read_file(watershed_file)
+    """
+    # this produces all parcels touching the watershed
+    val_gdf = gp.sjoin(gdf, val, how='inner', op='intersects')
+    val['Name'] = 'Warner_Watershed'
+    val_gdf = pd.concat([val, val_gdf])
+    val_gdf.crs = 'epsg:4326'
+    """
+    # this produces all area interior to the watershed
+    val_gdf = gp.overlay(gdf, val, how='intersection')
+    val['Name'] = 'Warner_Watershed'
+    extra = gp.overlay(val, val_gdf, how='difference')
+    val_gdf = val_gdf.append(extra)
+
+    return val_gdf[~(val_gdf['Name'].isin(OVERLAPPING))]
+
+
+def select(val_gdf, apns=None):
+    """
+    Rows of val_gdf for apns, all of them if apns is empty
+    """
+    if not apns:
+        return val_gdf
+    missing = set(apns) - set(val_gdf['Name'])
+    if missing:
+        raise ValueError(f'unknown apns: {sorted(missing)}')
+    return val_gdf[val_gdf['Name'].isin(apns)]
@@ -1,65 +1,185 @@
+import os
+import json
+import contextlib
+import concurrent.futures
 import numpy as np
 import rasterio
 import rasterio.plot
-import rasterio.mask
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.colors as colors
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
 from matplotlib.gridspec import GridSpec
 
+import regen
+import contours
+import instrument
+import utils as reutil
 
-METERS_IN_FT = .3048
-M2_IN_ACRE = 4046.8564224
 
+METERS_IN_FT = .3048
 
-def plot_contour(outfile, aoi, figdir, meters=False, cont=None, intv=None, linethick=1, cfont=5):
-    # contour figure
-    with rasterio.open(outfile, 'r') as src:
-        data = src.read(1)
-        meta = src.meta
-        bounds = src.bounds
-        res = src.res
+# figures are drawn on one reused Agg figure per process, never through
+# pyplot, so nothing is left open between parcels. Raster arguments are
+# paths or in memory utils.Raster.
+DPI = {'preview': 100, 'production': 300}
+QUALITY = 'production'
+_FIG = None
+# pages of a native pdf report while one is open, see report()
+_REPORT = None
+
+
+def set_quality(quality):
+    global QUALITY
+    if quality not in DPI:
+        raise ValueError(f'quality must be one of {list(DPI)}')
+    QUALITY = quality
+
+
+def get_figure(figsize=(12, 12)):
+    """
+    The cleared figure of this process, at the current quality dpi
+    """
+    global _FIG
+    if _FIG is None:
+        _FIG = Figure()
+        FigureCanvasAgg(_FIG)
+    _FIG.clear()
+    _FIG.set_size_inches(figsize)
+    _FIG.set_dpi(DPI[QUALITY])
+    return _FIG
+
+
+@contextlib.contextmanager
+def report(pdf, pages, write_files=True):
+    """
+    While open, figures whose file name (without extension) is in pages are
+    also saved as pages of pdf (a PdfPages), and must be drawn in the order
+    of pages. With write_files=False those figures skip their own files.
+    Yields the list of page names written so far.
+    """
+    global _REPORT
+    _REPORT = {'pdf': pdf, 'pages': list(pages), 'done': [],
+               'write_files': write_files}
+    try:
+        yield _REPORT['done']
+    finally:
+        _REPORT = None
+
+
+def save_figure(fig, figfile):
+    name = os.path.splitext(os.path.basename(figfile))[0]
+    if _REPORT is not None and name in _REPORT['pages']:
+        done = _REPORT['done']
+        expected = (_REPORT['pages'] + [None])[len(done)]
+        if name != expected:
+            raise ValueError(f'report page {name} drawn out of order, expected {expected}')
+        _REPORT['pdf'].savefig(fig, dpi=DPI[QUALITY])
+        done.append(name)
+        if not _REPORT['write_files']:
+            fig.clear()
+            return figfile
+    fig.savefig(figfile, dpi=DPI[QUALITY])
+    fig.clear()
+    return figfile
 
-    xxx = np.linspace(bounds[0], bounds[2], meta['width'])
-    yyy = np.linspace(bounds[1], bounds[3], meta['height'])
 
-    # crop interpolated area off
-    crop = 4  # pixels
-    xxx = xxx[crop:-crop]
-    yyy = yyy[crop:-crop]
-    data = data[crop:-crop, crop:-crop]
+def plot_boundary(ax, aoi, color, linewidth=2):
+    """
+    Parcel boundary as a single LineCollection (geopandas plotting goes
+    through pyplot)
+    """
+    lines = []
+    for geom in aoi.geometry.boundary:
+        parts = getattr(geom, 'geoms', [geom])
+        lines.extend(np.asarray(part.coords)[:, :2] for part in parts)
+    ax.add_collection(LineCollection(lines, colors=color,
+                                     linewidths=linewidth), autolim=True)
+    ax.autoscale_view()
+
+
+def render(jobs, workers=1, quality=None):
+    """
+    Run plotting jobs, a list of (function name, args, kwargs), either in
+    this process or over a pool of worker processes each with its own
+    figure. Returns the results in job order. An open report() needs the
+    figures of this process, so jobs then always run here.
+    """
+    quality = quality or QUALITY
+    if workers <= 1 or _REPORT is not None:
+        set_quality(quality)
+        return [render_job(name, args, kwargs) for name, args, kwargs in jobs]
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=set_quality,
+            initargs=(quality,)) as pool:
+        futures = [pool.submit(render_job, name, args, kwargs)
+                   for name, args, kwargs in jobs]
+        return [future.result() for future in futures]
+
+
+def render_job(name, args, kwargs):
+    with instrument.span(name):
+        return globals()[name](*args, **kwargs)
+
+
+def label_contours(ax, features, fontsize, min_frac=0.05):
+    """
+    One label at the middle of each index contour long enough to read,
+    rotated along the line
+    """
+    (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+    min_len = min_frac * max(x1-x0, y1-y0)
+    for feature in features:
+        if not feature['properties']['major']:
+            continue
+        line = np.asarray(feature['geometry']['coordinates'])
+        steps = np.hypot(*np.diff(line, axis=0).T)
+        if steps.sum() < min_len:
+            continue
+        i = int(np.searchsorted(np.cumsum(steps), steps.sum()/2))
+        (xa, ya), (xb, yb) = line[i], line[i+1]
+        angle = np.degrees(np.arctan2(yb-ya, xb-xa))
+        if angle > 90 or angle < -90:
+            angle -= 180 * np.sign(angle)
+        ax.text((xa+xb)/2, (ya+yb)/2, f"{feature['properties']['level']:1.0f}",
+                fontsize=fontsize, rotation=angle, ha='center', va='center',
+                rotation_mode='anchor',
+                bbox={'facecolor': 'white', 'edgecolor': 'none', 'pad': 0})
 
-    yyy = np.flip(yyy)
-    X, Y = np.meshgrid(xxx, yyy)
 
+def plot_contour(outfile, aoi, figdir, meters=False, cont=None, intv=None, linethick=1, cfont=5):
+    # contour figure, drawn from the cached contour lines of the dem
     if meters:
-        z = data
         cont = cont or 0.5
         intv = intv or 5
-
     else:
-        z = data/METERS_IN_FT
         cont = cont or 1
         intv = intv or 10
 
-    lowm = np.floor(np.min(z))
-    highm = np.ceil(np.max(z))
-    levels = np.arange(lowm-lowm % intv, highm, cont)
-    thick = np.ones(len(levels))/2 * linethick
-    thick[np.squeeze((np.argwhere(levels % intv == 0)))] = 1 * linethick
-    labels = np.arange(lowm-lowm % intv, highm, intv).astype(int)
-
-    fig, ax = plt.subplots(1, 1)
-    fig.set_size_inches((12, 12))
-    contours = plt.contour(
-        X, Y, z, levels, colors='black', linewidths=thick)
-    plt.clabel(contours, labels, inline=1, fontsize=cfont, fmt='%1.0f')
-    plt.xlabel('East')
-    plt.ylabel('North')
-    plt.title(f'Contour map of Parcel #{aoi.Name.iloc[0]}')
+    with open(contours.get_contours(outfile, intv, cont, meters=meters)) as f:
+        features = json.load(f)['features']
+
+    lines = {True: [], False: []}
+    for feature in features:
+        lines[feature['properties']['major']].append(
+            np.asarray(feature['geometry']['coordinates']))
+
+    fig = get_figure()
+    ax = fig.add_subplot(1, 1, 1)
+    ax.add_collection(LineCollection(lines[False], colors='black',
+                                     linewidths=linethick/2))
+    ax.add_collection(LineCollection(lines[True], colors='black',
+                                     linewidths=linethick))
+    ax.autoscale_view()
+    label_contours(ax, features, cfont)
+    ax.set_xlabel('East')
+    ax.set_ylabel('North')
+    ax.set_title(f'Contour map of Parcel #{aoi.Name.iloc[0]}')
     # add prop line
-    aoi.geometry.boundary.plot(
-        color=None, edgecolor='k', linewidth=2, ax=ax)
+    plot_boundary(ax, aoi, 'k')
 
     # add scale
     mlen = 100*METERS_IN_FT
@@ -71,52 +191,53 @@ def plot_contour(outfile, aoi, figdir, meters=False, cont=None, intv=None, linet
                                size_vertical=1)
     ax.add_artist(scalebar)
     figfile = f'{figdir}/contour.pdf'
-    plt.savefig(figfile)
-    plt.close()
-    return figfile
+    return save_figure(fig, figfile)
+
+
+def show_band(raster, ax, **kwargs):
+    """
+    rasterio.plot.show of the first band of a path or a Raster, a Raster
+    is shown from its array with nodata masked like a dataset read
+    """
+    if not isinstance(raster, reutil.Raster):
+        with rasterio.open(raster) as src:
+            return rasterio.plot.show(src, ax=ax, **kwargs)
+    arr = raster.array[0]
+    if raster.nodata is None:
+        arr = np.ma.masked_array(arr)
+    elif np.isnan(raster.nodata):
+        arr = np.ma.masked_invalid(arr)
+    else:
+        arr = np.ma.masked_equal(arr, raster.nodata)
+    return rasterio.plot.show(arr, transform=raster.transform, ax=ax, **kwargs)
 
 
 def plot_hill(hillshade_file, aoi, figdir):
     # hillshade figure
-    fig, ax = plt.subplots(1, 1)
-    fig.set_size_inches((12, 12))
-    fig.set_dpi(300)
-    with rasterio.open(hillshade_file, 'r') as src:
-        rasterio.plot.show(src, ax=ax, cmap='gray', interpolation='none')
-    aoi.geometry.boundary.plot(
-        color=None, edgecolor='w', linewidth=2, ax=ax)
-    ax.set_title('Hillshade')
-    plt.xlabel('East')
-    plt.ylabel('North')
-    plt.title(f'Hillshade of Parcel #{aoi.Name.iloc[0]}')
+    fig = get_figure()
+    ax = fig.add_subplot(1, 1, 1)
+    show_band(hillshade_file, ax, cmap='gray', interpolation='none')
+    plot_boundary(ax, aoi, 'w')
+    ax.set_xlabel('East')
+    ax.set_ylabel('North')
+    ax.set_title(f'Hillshade of Parcel #{aoi.Name.iloc[0]}')
     figfile = f'{figdir}/hillshade.png'
-    plt.savefig(figfile)
-    plt.close()
-    return figfile
+    return save_figure(fig, figfile)
 
 
 def plot_slope(slope_file, aoi, figdir):
     # slope figure
-    with rasterio.open(slope_file, 'r') as src:
-        data = src.read(1)
-        fig, ax = plt.subplots(1, 1)
-        image_hidden = ax.imshow(data, cmap='gray', vmin=0, vmax=30)
-        fig, ax = plt.subplots(1, 1)
-        fig.set_size_inches((12, 12))
-        fig.set_dpi(300)
-        rasterio.plot.show(src, ax=ax, cmap='gray',
-                           interpolation='none', vmin=0, vmax=30)
-        fig.colorbar(image_hidden, ax=ax)
-        ax.set_title('Slope [degrees]')
-        plt.xlabel('East')
-        plt.ylabel('North')
-        ax.set_title(f'Slope [degrees] of Parcel #{aoi.Name.iloc[0]}')
-    aoi.geometry.boundary.plot(
-        color=None, edgecolor='r', linewidth=2, ax=ax)
+    fig = get_figure()
+    ax = fig.add_subplot(1, 1, 1)
+    show_band(slope_file, ax, cmap='gray', interpolation='none', vmin=0, vmax=30)
+    # the shown image is the colorbar mappable
+    fig.colorbar(ax.images[-1], ax=ax)
+    ax.set_xlabel('East')
+    ax.set_ylabel('North')
+    ax.set_title(f'Slope [degrees] of Parcel #{aoi.Name.iloc[0]}')
+    plot_boundary(ax, aoi, 'r')
     figfile = f'{figdir}/slope.png'
-    plt.savefig(figfile)
-    plt.close()
-    return figfile
+    return save_figure(fig, figfile)
 
 
 def plot_ba(ba_file, aoi, figdir):
@@ -127,66 +248,74 @@ def plot_ba(ba_file, aoi, figdir):
                 n=cmap.name, a=minval, b=maxval),
             cmap(np.linspace(minval, maxval, n)))
         return new_cmap
-    cmap = plt.get_cmap('hot')
+    cmap = matplotlib.colormaps['hot']
     new_cmap = truncate_colormap(cmap, 0.0, 0.8)
 
     # ba figure
-    fig, ax = plt.subplots(1, 1)
-    fig.set_size_inches((12, 12))
-    fig.set_dpi(300)
-    with rasterio.open(ba_file, 'r') as src:
-        fig, ax = plt.subplots(1, 1)
-        image_hidden = ax.imshow(src.read(1), cmap=new_cmap, vmin=0)
-        fig, ax = plt.subplots(1, 1)
-        fig.set_size_inches((12, 12))
-        fig.set_dpi(300)
-        rasterio.plot.show(src, ax=ax, cmap=new_cmap,
-                           interpolation='none', vmin=0)
-        fig.colorbar(image_hidden, ax=ax)
-        ax.set_title('Basal Area Loss [percent]')
-        plt.xlabel('East')
-        plt.ylabel('North')
-        plt.title(f'Basal Area loss percentage of Parcel #{aoi.Name.iloc[0]}')
-    aoi.geometry.boundary.plot(
-        color=None, edgecolor='r', linewidth=2, ax=ax)
+    fig = get_figure()
+    ax = fig.add_subplot(1, 1, 1)
+    show_band(ba_file, ax, cmap=new_cmap, interpolation='none', vmin=0)
+    # the shown image is the colorbar mappable
+    fig.colorbar(ax.images[-1], ax=ax)
+    ax.set_xlabel('East')
+    ax.set_ylabel('North')
+    ax.set_title(f'Basal Area loss percentage of Parcel #{aoi.Name.iloc[0]}')
+    plot_boundary(ax, aoi, 'r')
     figfile = f'{figdir}/ba.png'
-    plt.savefig(figfile)
-    plt.close()
-    return figfile
+    return save_figure(fig, figfile)
 
 
 def plot_naip(naip_file, aoi, figdir):
-    fig, ax = plt.subplots(1, 1)
-    fig.set_size_inches((12, 12))
-    fig.set_dpi(300)
-    with rasterio.open(naip_file, 'r') as src:
+    fig = get_figure()
+    ax = fig.add_subplot(1, 1, 1)
+    with rasterio.open(naip_file) as src:
         extent = rasterio.plot.plotting_extent(src)
         arr = src.read()[0:3]
         arr = rasterio.plot.reshape_as_image(arr)
         arr[arr == 0] = 255
-        plt.imshow(arr, extent=extent)
-        plt.xlabel('East')
-        plt.ylabel('North')
-        plt.title(f'RGB Aerial Imagery of Parcel #{aoi.Name.iloc[0]}')
-    aoi.geometry.boundary.plot(
-        color=None, edgecolor='r', linewidth=2, ax=ax)
+        ax.imshow(arr, extent=extent)
+        ax.set_xlabel('East')
+        ax.set_ylabel('North')
+        ax.set_title(f'RGB Aerial Imagery of Parcel #{aoi.Name.iloc[0]}')
+    plot_boundary(ax, aoi, 'r')
     figfile = f'{figdir}/naip.png'
-    plt.savefig(figfile)
-    plt.close()
-    return figfile
+    return save_figure(fig, figfile)
+
+
+def class_colors():
+    """
+    (3, 4, 3) table of rgb colors for the slope rows and BA columns
+    """
+    cms = [matplotlib.colormaps['Purples'],
+           matplotlib.colormaps['Blues'],
+           matplotlib.colormaps['Greens'],
+           matplotlib.colormaps['Oranges'],
+           ]
+    cell_colors = np.zeros((regen.N_ROWS, regen.N_COLS, 3))
+    for ii in range(regen.N_ROWS):
+        val = int(np.max((200*(ii+1)/3, 50)))
+        for jj, cm in enumerate(cms):
+            cell_colors[ii, jj, :] = cm(val)[0:3]
+    return cell_colors
+
+
+def class_lut(cell_colors):
+    """
+    uint8 rgb lookup table indexed by regen class
+    """
+    lut = np.zeros((regen.N_CLASSES + 2, 3), np.uint8)
+    lut[:regen.N_CLASSES] = (cell_colors.reshape(-1, 3)*255).astype(np.uint8)
+    lut[regen.NO_BA] = [0, 0, 0]
+    lut[regen.NO_DATA] = [255, 255, 255]
+    return lut
 
 
 def plot_regen(slope_file, ba_file, naip_file, aoi, figdir):
     poly = [aoi.iloc[0].geometry]
-    with rasterio.open(slope_file, 'r') as src:
-        slope, trans_slope = rasterio.mask.mask(
-            src, poly, nodata=np.NaN, crop=True)
-        res = src.res
-        meta = src.meta
-
-    with rasterio.open(ba_file, 'r') as src:
-        ba, trans_ba = rasterio.mask.mask(
-            src, poly, nodata=np.NaN, crop=True)
+    # a Raster is masked on its array, a path through rasterio.mask
+    slope, trans_slope = reutil.crop_to_aoi(slope_file, poly)[:2]
+    res = (trans_slope.a, -trans_slope.e)
+    ba = reutil.crop_to_aoi(ba_file, poly).array
 
     # demand same dimensions
     xa = int(np.min((slope.shape[1], ba.shape[1])))
@@ -194,45 +323,19 @@ def plot_regen(slope_file, ba_file, naip_file, aoi, figdir):
     slope = slope[0, 0:xa, 0:ya]
     ba = ba[0, 0:xa, 0:ya]
 
-    # categories of slope
-    slope30 = slope >= 30
-    slope15 = (slope >= 15) & (slope < 30)
-    slope0 = slope < 15
-    ba75 = ba >= 75
-    ba50 = (ba >= 50) & (ba < 75)
-    ba25 = (ba >= 25) & (ba < 50)
-    ba0 = ba < 25
-
     # categories of slope*ba
-    pixel_acres = res[0]*res[1]*(1/M2_IN_ACRE)
+    pixel_acres = res[0]*res[1]*(1/regen.M2_IN_ACRE)
     acres_raster = np.isfinite(slope).astype('bool').sum()*pixel_acres
-    acres_poly = aoi.unary_union.area/M2_IN_ACRE
+    acres_poly = aoi.unary_union.area/regen.M2_IN_ACRE
     fac = acres_poly/acres_raster
 
-    colorarr = np.zeros(slope.shape+(3,)).astype(np.uint8)
-    colorarr[~np.isfinite(slope), :] = [255, 255, 255]
-    cell_text = []
-    cell_colors = np.zeros((3, 4, 3))
-    slopes = [slope30, slope15, slope0]
-    bas = [ba0, ba25, ba50, ba75]
-    cms = [plt.get_cmap('Purples'),
-           plt.get_cmap('Blues'),
-           plt.get_cmap('Greens'),
-           plt.get_cmap('Oranges'),
-           ]
-    for ii, ss in enumerate(slopes):
-        ss = ss*pixel_acres
-        cc = []
-        for jj, (bb, cm) in enumerate(zip(bas, cms)):
-            val = int(np.max((200*(ii+1)/3, 50)))
-            color = np.array(cm(val)[0:3])
-            cell_colors[ii, jj, :] = color
-            colorarr[(ss*bb).astype('bool'), :] = (color*255).astype(np.uint8)
-            cc.append(np.round(np.sum(ss*bb)*fac, 2))
-        cell_text.append(cc)
+    classes = regen.classify(slope, ba)
+    cell_text = regen.class_acres(classes, pixel_acres, fac).tolist()
+    cell_colors = class_colors()
+    colorarr = class_lut(cell_colors)[classes]
 
     # plot map
-    fig = plt.figure(figsize=(14, 16), dpi=300)
+    fig = get_figure((14, 16))
     gs = GridSpec(4, 2, figure=fig)
 
     ax1 = fig.add_subplot(gs[0: 2, 0])
@@ -284,19 +387,16 @@ def plot_regen(slope_file, ba_file, naip_file, aoi, figdir):
               fontsize=18,
               )
     figfile = f'{figdir}/ba_slope_hist.png'
-    plt.savefig(figfile)
-    plt.close()
+    save_figure(fig, figfile)
 
     # also plot slope*ba as stand alone figure
-    fig, ax = plt.subplots(1, 1)
-    fig.set_size_inches((12, 12))
-    fig.set_dpi(300)
-    plt.imshow(colorarr, extent=extent)
-    plt.xlabel('East')
-    plt.ylabel('North')
-    plt.title(f'Slope * Basal Area loss of Parcel #{aoi.Name.iloc[0]}')
+    fig = get_figure()
+    ax = fig.add_subplot(1, 1, 1)
+    ax.imshow(colorarr, extent=extent)
+    ax.set_xlabel('East')
+    ax.set_ylabel('North')
+    ax.set_title(f'Slope * Basal Area loss of Parcel #{aoi.Name.iloc[0]}')
     figfile = f'{figdir}/ba_slope.png'
-    plt.savefig(figfile)
-    plt.close()
+    save_figure(fig, figfile)
 
     return figfile, cell_text
@@ -0,0 +1,40 @@
+"""
+BA x slope classification used for the regeneration tables, numpy only so
+the acreages can be computed without matplotlib.
+
+Classes are numbered row major over the table in plot_regen:
+rows are slope (>=30, 15-30, <15 degrees), columns are BA loss
+(<25, 25-50, 50-75, >=75 percent), so class = 4*row + col.
+"""
+import numpy as np
+
+M2_IN_ACRE = 4046.8564224
+SLOPE_BINS = [15, 30]
+BA_BINS = [25, 50, 75]
+N_ROWS = len(SLOPE_BINS) + 1
+N_COLS = len(BA_BINS) + 1
+N_CLASSES = N_ROWS * N_COLS
+# pixels outside the table
+NO_BA = N_CLASSES  # finite slope but no BA value
+NO_DATA = N_CLASSES + 1  # no slope value
+
+
+def classify(slope, ba):
+    """
+    Class index of every pixel, NO_BA / NO_DATA where a value is missing
+    """
+    row = (N_ROWS - 1) - np.digitize(slope, SLOPE_BINS)
+    col = np.digitize(ba, BA_BINS)
+    classes = (row * N_COLS + col).astype(np.uint8)
+    classes[~np.isfinite(ba)] = NO_BA
+    classes[~np.isfinite(slope)] = NO_DATA
+    return classes
+
+
+def class_acres(classes, pixel_acres, fac=1):
+    """
+    (3, 4) array of acres per slope row and BA column, from one bincount
+    """
+    counts = np.bincount(classes.ravel(), minlength=N_CLASSES + 2)
+    acres = counts[:N_CLASSES] * pixel_acres * fac
+    return np.round(acres, 2).reshape(N_ROWS, N_COLS)
@@ -0,0 +1,107 @@
+"""
+Per parcel results in one sqlite table, written as each parcel finishes.
+
+Rows are the one row frames of table.apn_row, one column per table column
+plus the parcel geometry as WKB. The store is opened in WAL mode so the
+table and the owner summary can be read while a run is still writing.
+
+Rows of the per parcel pipeline and of the watershed wide zonal pass
+(workflow.zonal_table) are computed differently, so they are kept in
+separate tables and never replace each other.
+"""
+import os
+import time
+import sqlite3
+import pandas as pd
+import shapely.wkb
+
+RESULTS_DB = '../results.sqlite'
+PARCEL_TABLE = 'results'
+ZONAL_TABLE = 'zonal'
+
+
+class MissingResults(FileNotFoundError):
+    """
+    The store, or the table asked for, has not been written yet
+    """
+
+
+def connect(db_file=RESULTS_DB):
+    os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+    con = sqlite3.connect(db_file, timeout=60)
+    con.execute('PRAGMA journal_mode=WAL')
+    return con
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def value_columns(df):
+    return [col for col in df.columns if col not in ('APN', 'geometry')]
+
+
+def create_table(con, columns, table=PARCEL_TABLE):
+    cols = ''.join(f', {quote(col)} REAL' for col in columns)
+    con.execute(f"""CREATE TABLE IF NOT EXISTS {quote(table)} (
+                    APN TEXT PRIMARY KEY{cols}, geometry BLOB, updated REAL)""")
+
+
+def store(df, db_file=RESULTS_DB, table=PARCEL_TABLE):
+    """
+    Insert or replace the rows of df (table.apn_row frames, or a concat
+    of them) in one transaction
+    """
+    columns = value_columns(df)
+    names = ['APN'] + columns + ['geometry', 'updated']
+    sql = (f"INSERT OR REPLACE INTO {quote(table)} "
+           f"({', '.join(quote(n) for n in names)}) "
+           f"VALUES ({', '.join('?' for _ in names)})")
+    now = time.time()
+    rows = [(str(apn), *[float(v) for v in values],
+             None if geom is None else shapely.wkb.dumps(geom), now)
+            for apn, values, geom in zip(df['APN'], df[columns].values,
+                                         df['geometry'])]
+    con = connect(db_file)
+    with con:
+        create_table(con, columns, table)
+        con.executemany(sql, rows)
+    con.close()
+
+
+def has_results(db_file=RESULTS_DB, table=PARCEL_TABLE):
+    """
+    Whether db_file exists and has table, without creating it
+    """
+    if not os.path.exists(db_file):
+        return False
+    con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True, timeout=60)
+    table = con.execute("SELECT name FROM sqlite_master "
+                        "WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    con.close()
+    return table is not None
+
+
+def read(db_file=RESULTS_DB, apns=None, geometry=False, table=PARCEL_TABLE):
+    """
+    Stored rows of table as a frame with the columns of table.apn_row, in
+    apns order when given (apns without a result are left out).
+    Geometries are only decoded when asked for.
+    """
+    if not has_results(db_file, table):
+        raise MissingResults(f'no {table} rows in {db_file}, '
+                                'run `python cli.py process` first')
+    con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True, timeout=60)
+    df = pd.read_sql_query(f'SELECT * FROM {quote(table)} ORDER BY rowid', con)
+    con.close()
+    df = df.drop('updated', axis=1)
+    df.index = df['APN'].values
+    if apns is not None:
+        stored = set(df.index)
+        df = df.loc[[apn for apn in apns if apn in stored]]
+    if geometry:
+        df['geometry'] = [None if geom is None else shapely.wkb.loads(geom)
+                          for geom in df['geometry']]
+    else:
+        df = df.drop('geometry', axis=1)
+    return df
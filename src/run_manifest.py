@@ -0,0 +1,85 @@
+"""
+Input fingerprints of the work done for each parcel, so reruns only redo
+what changed and interrupted runs pick up where they stopped.
+
+Every (key, stage) pair records the sha256 of its inputs (geometry WKB
+hashes, source file digests, parameters) and the files it produced. A
+stage is current when the fingerprint matches and those files still
+exist.
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+MANIFEST_DB = '../run_manifest.sqlite'
+
+
+def connect(db_file=MANIFEST_DB):
+    os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+    con = sqlite3.connect(db_file, timeout=60)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute("""CREATE TABLE IF NOT EXISTS stages (
+                   key TEXT, stage TEXT, fingerprint TEXT, outputs TEXT,
+                   updated REAL, PRIMARY KEY (key, stage))""")
+    return con
+
+
+def geometry_hash(geom):
+    return hashlib.sha256(geom.wkb).hexdigest()
+
+
+def fingerprint(inputs):
+    """
+    sha256 of a json serializable dict of inputs, independent of key order
+    """
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def output_paths(outputs):
+    if isinstance(outputs, str):
+        return [outputs]
+    return [path for path in outputs if path is not None]
+
+
+def current(key, stage, stamp, db_file=MANIFEST_DB):
+    """
+    Recorded outputs of the stage if it ran with the same fingerprint and
+    its files still exist, None otherwise
+    """
+    con = connect(db_file)
+    row = con.execute('SELECT fingerprint, outputs FROM stages '
+                      'WHERE key = ? AND stage = ?', (key, stage)).fetchone()
+    con.close()
+    if row is None or row[0] != stamp:
+        return None
+    outputs = json.loads(row[1])
+    if not all(os.path.exists(path) for path in output_paths(outputs)):
+        return None
+    return tuple(outputs) if isinstance(outputs, list) else outputs
+
+
+def record(key, stage, stamp, outputs, db_file=MANIFEST_DB):
+    con = connect(db_file)
+    with con:
+        con.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)',
+                    (key, stage, stamp, json.dumps(outputs), time.time()))
+    con.close()
+
+
+def run_stage(key, stage, inputs, func, db_file=MANIFEST_DB):
+    """
+    Outputs of func(), a path or a tuple of paths. func only runs when the
+    inputs differ from the last recorded run of this key and stage, or
+    when one of its outputs is gone.
+    """
+    stamp = fingerprint(inputs)
+    outputs = current(key, stage, stamp, db_file)
+    if outputs is not None:
+        print(f'{key} {stage} is up to date, skipping...')
+        return outputs
+    outputs = func()
+    record(key, stage, stamp, outputs, db_file)
+    return outputs
@@ -0,0 +1,139 @@
+"""
+Local stand-ins for the remote services the pipeline reads from, so it
+can run offline (see benchmark.py).
+
+start_dem_service serves the 3DEP exportImage endpoint from an analytic
+elevation surface, start_s3_service serves files from disk as objects of
+an s3 bucket (HEAD and ranged GET, path style addressing). Both run on a
+daemon thread of this process.
+"""
+import os
+import hashlib
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import rasterio
+import rasterio.transform
+from rasterio.io import MemoryFile
+
+
+def synthetic_elevation(x, y):
+    """
+    Smooth hills and valleys [m] at epsg:3857 coordinates
+    """
+    return (1500 + 200*np.sin(x/900.)*np.cos(y/700.)
+            + 40*np.sin((x+y)/260.) + 0.01*(x % 5000))
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_dem_service(elevation=synthetic_elevation):
+    """
+    exportImage stand-in, answers bbox/size requests with a float32
+    epsg:3857 GeoTIFF of elevation(x, y) at the pixel centers.
+    Returns (base url, server).
+    """
+    class DemHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            bbox = [float(v) for v in query['bbox'][0].split(',')]
+            width, height = [int(v) for v in query['size'][0].split(',')]
+            transform = rasterio.transform.from_bounds(*bbox, width, height)
+            cols = np.arange(width) + 0.5
+            rows = np.arange(height) + 0.5
+            x = transform.c + cols*transform.a
+            y = transform.f + rows*transform.e
+            data = elevation(x[np.newaxis, :], y[:, np.newaxis]).astype(np.float32)
+            with MemoryFile() as mem:
+                with mem.open(driver='GTiff', width=width, height=height,
+                              count=1, dtype='float32', crs='epsg:3857',
+                              transform=transform) as dst:
+                    dst.write(data, 1)
+                body = mem.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/tiff')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = serve(DemHandler)
+    return f'http://127.0.0.1:{server.server_port}/exportImage?', server
+
+
+def start_s3_service(objects, bucket='naip-source'):
+    """
+    s3 stand-in serving objects, a dict of key -> local file, from bucket.
+    Keys can be added to the dict while the service runs.
+    Returns (endpoint url, server).
+    """
+    etags = {}
+
+    def etag(path):
+        if path not in etags:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    md5.update(chunk)
+            etags[path] = md5.hexdigest()
+        return etags[path]
+
+    class S3Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def lookup(self):
+            path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+            prefix = f'/{bucket}/'
+            if not path.startswith(prefix) or path[len(prefix):] not in objects:
+                self.send_response(404)
+                self.end_headers()
+                return None
+            return objects[path[len(prefix):]]
+
+        def headers_for(self, path, length, code=200, extra=()):
+            self.send_response(code)
+            self.send_header('ETag', f'"{etag(path)}"')
+            self.send_header('Content-Length', str(length))
+            for key, value in extra:
+                self.send_header(key, value)
+            self.end_headers()
+
+        def do_HEAD(self):
+            path = self.lookup()
+            if path is not None:
+                self.headers_for(path, os.path.getsize(path))
+
+        def do_GET(self):
+            path = self.lookup()
+            if path is None:
+                return
+            size = os.path.getsize(path)
+            start, stop = 0, size - 1
+            byte_range = self.headers.get('Range')
+            if byte_range:
+                first, last = byte_range.split('=')[1].split('-')
+                start = int(first)
+                stop = int(last) if last else size - 1
+            with open(path, 'rb') as f:
+                f.seek(start)
+                body = f.read(stop - start + 1)
+            if byte_range:
+                self.headers_for(path, len(body), 206,
+                                 [('Content-Range', f'bytes {start}-{stop}/{size}')])
+            else:
+                self.headers_for(path, len(body))
+            self.wfile.write(body)
+
+    server = serve(S3Handler)
+    return f'http://127.0.0.1:{server.server_port}', server
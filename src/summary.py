@@ -1,37 +1,39 @@
 import pandas as pd
 import json
 
+import results
 
-def owners():
 
-    owners_file = 'apns.json'
+OWNERS = ['USFS', 'NPS', 'CDFW']
+PRIVATE = 'PRIVATE'
+
+
+def owner_map(owners_file='apns.json'):
+    """
+    APN -> owner of the public parcels in owners_file, first owner listed
+    wins
+    """
     with open(owners_file) as src:
         owners = json.load(src)
-    # owners = pd.read_json(owners_file)
-    df = pd.read_csv("../table.csv")
-
-    usfs = df[df['APN'].isin(owners['USFS'])]
-    usfs_out = usfs.sum().to_frame().transpose().drop(
-        ['APN', 'Unnamed: 0'], axis=1)
-    usfs_out['owner'] = 'USFS'
-
-    nps = df[df['APN'].isin(owners['NPS'])]
-    nps_out = nps.sum().to_frame().transpose().drop(
-        ['APN', 'Unnamed: 0'], axis=1)
-    nps_out['owner'] = 'NPS'
-
-    cdfw = df[df['APN'].isin(owners['CDFW'])]
-    cdfw_out = cdfw.sum().to_frame().transpose().drop(
-        ['APN', 'Unnamed: 0'], axis=1)
-    cdfw_out['owner'] = 'CDFW'
-
-    private = df[~df['APN'].isin(owners['USFS']+owners['NPS']+owners['CDFW'])]
-    private_out = private.sum().to_frame().transpose().drop(
-        ['APN', 'Unnamed: 0'], axis=1)
-    private_out['owner'] = 'PRIVATE'
-
-    out = pd.concat([usfs_out, nps_out, cdfw_out, private_out])
-    out = out.set_index('owner')
+    apn_owner = {}
+    for owner in OWNERS:
+        for apn in owners[owner]:
+            apn_owner.setdefault(apn, owner)
+    return apn_owner
+
+
+def owners(db_file=results.RESULTS_DB, owners_file='apns.json',
+           table=results.PARCEL_TABLE):
+    """
+    Acres per owner from table of the results store, in one groupby.
+    Parcels not listed in owners_file are private. Works on a partly
+    finished run.
+    """
+    df = results.read(db_file, table=table)
+    owner = df['APN'].map(owner_map(owners_file)).fillna(PRIVATE)
+
+    out = df.drop('APN', axis=1).groupby(owner.rename('owner')).sum()
+    out = out.reindex(OWNERS + [PRIVATE], fill_value=0)
     out = out.sort_values('BA>75 All Slopes', ascending=False)
     out = out.astype(float).round(2)
 
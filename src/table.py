@@ -1,13 +1,50 @@
 import pandas as pd
 import shutil
 
+import results
 
-def to_table(df):
+
+def apn_row(apn, cell_text, geometry):
+    """
+    One row of the parcel table from the (3, 4) BA x slope acres
+    (rows slope >30, 30-15, <15; columns BA <25, 25-50, 50-75, >75)
+    """
+    cell_text = [list(row) for row in cell_text]
+    all_75 = cell_text[0][3]+cell_text[1][3]+cell_text[2][3]
+
+    sub = pd.DataFrame({'APN': apn,
+                        'BA>75 All Slopes': all_75,
+                        'BA>75 & S>30': cell_text[0][3],
+                        'BA>75 & 30>S>15': cell_text[1][3],
+                        'BA>75 & S<15': cell_text[2][3],
+                        'BA<75,BA>50  and S>30': cell_text[0][2],
+                        'BA<75,BA>50  and 30>S>15': cell_text[1][2],
+                        'BA<75,BA>50 and S<15': cell_text[2][2],
+                        'BA<50,BA>25 and S>30': cell_text[0][1],
+                        'BA<50,BA>25 and 30>S>15': cell_text[1][1],
+                        'BA<50,BA>25 and S<15': cell_text[2][1],
+                        'BA<25 and S>30': cell_text[0][0],
+                        'BA<25 and 30>S>15': cell_text[1][0],
+                        'BA<25 and S<15': cell_text[2][0],
+                        'geometry': [geometry],
+                        }, index=[apn]
+                       )
+    return sub
+
+
+def to_table(df=None, db_file=results.RESULTS_DB, table=results.PARCEL_TABLE):
+    """
+    table.html and table.csv from df, by default every row of table in the
+    results store
+    """
+    if df is None:
+        df = results.read(db_file, table=table)
+    df = df.copy()
     df['Report'] = df['APN'].apply(
         lambda x: f"<a href= 'doc/{x}.pdf'> {x}</a>")
     df = df.sort_values('BA>75 All Slopes', ascending=False)
     df = df.reset_index(drop=True)
-    df = df.drop('geometry', axis=1)
+    df = df.drop('geometry', axis=1, errors='ignore')
 
     pd.set_option('colheader_justify', 'center')   # FOR TABLE <th>
     html_string = '''
@@ -0,0 +1,105 @@
+"""
+Terrain products of a dem from one gradient pass.
+
+Gradients use Horn's weighted 3x3 differences, with the neighbours of the
+center pixel e labelled
+
+    a b c
+    d e f
+    g h i
+
+dz/dx = ((c + 2f + i) - (a + 2d + g)) / (8 xres)
+dz/dy = ((g + 2h + i) - (a + 2b + c)) / (8 yres)
+
+(rows run north to south, so dz/dy is the rise towards the south, as in
+the ESRI definitions). Slope, aspect and hillshade are all derived from
+these two arrays, in float32, into caller supplied buffers.
+"""
+import numpy as np
+
+
+def horn_gradients(padded, xres, yres, dzdx=None, dzdy=None):
+    """
+    Horn gradients of the interior of padded, which carries a one pixel
+    border around the area of interest
+    """
+    padded = padded.astype(np.float32, copy=False)
+    shape = (padded.shape[0]-2, padded.shape[1]-2)
+    dzdx = np.empty(shape, np.float32) if dzdx is None else dzdx
+    dzdy = np.empty(shape, np.float32) if dzdy is None else dzdy
+
+    a, b, c = padded[:-2, :-2], padded[:-2, 1:-1], padded[:-2, 2:]
+    d, f = padded[1:-1, :-2], padded[1:-1, 2:]
+    g, h, i = padded[2:, :-2], padded[2:, 1:-1], padded[2:, 2:]
+
+    np.add(c, i, out=dzdx)
+    dzdx += f
+    dzdx += f
+    dzdx -= a
+    dzdx -= g
+    dzdx -= d
+    dzdx -= d
+    dzdx *= np.float32(1/(8*xres))
+
+    np.add(g, i, out=dzdy)
+    dzdy += h
+    dzdy += h
+    dzdy -= a
+    dzdy -= c
+    dzdy -= b
+    dzdy -= b
+    dzdy *= np.float32(1/(8*yres))
+    return dzdx, dzdy
+
+
+def products(padded, xres, yres, azdeg=315, altdeg=45,
+             slope=None, aspect=None, hillshade=None, scratch=None):
+    """
+    Slope [degrees], aspect [degrees clockwise from north, -1 where flat]
+    and hillshade [0-1] of the interior of padded.
+
+    Params:
+    padded: dem block with a one pixel border (see usgs_dsm.read_padded)
+    xres, yres: pixel size in the units of the dem
+    slope, aspect, hillshade: optional float32 output arrays
+    scratch: optional pair of float32 arrays for the gradients
+    """
+    shape = (padded.shape[0]-2, padded.shape[1]-2)
+    slope = np.empty(shape, np.float32) if slope is None else slope
+    aspect = np.empty(shape, np.float32) if aspect is None else aspect
+    hillshade = np.empty(shape, np.float32) if hillshade is None else hillshade
+    dzdx, dzdy = scratch if scratch is not None else (None, None)
+    dzdx, dzdy = horn_gradients(padded, xres, yres, dzdx=dzdx, dzdy=dzdy)
+
+    # hillshade = cos(zen) cos(s) + sin(zen) sin(s) cos(az - theta), with
+    # theta = atan2(dzdy, -dzdx) and s = atan(rise). Expanding with
+    # rise cos(theta) = -dzdx and rise sin(theta) = dzdy removes the trig.
+    zenith = np.radians(90 - altdeg)
+    azimuth = np.radians(360 - azdeg + 90)
+    rise2 = aspect  # borrow the aspect buffer until aspect is computed
+    np.multiply(dzdx, dzdx, out=rise2)
+    np.multiply(dzdy, dzdy, out=hillshade)
+    rise2 += hillshade
+    np.multiply(dzdx, np.float32(-np.sin(zenith)*np.cos(azimuth)), out=hillshade)
+    np.multiply(dzdy, np.float32(np.sin(zenith)*np.sin(azimuth)), out=slope)
+    hillshade += slope
+    hillshade += np.float32(np.cos(zenith))
+    np.add(rise2, np.float32(1), out=slope)
+    np.sqrt(slope, out=slope)
+    hillshade /= slope
+    np.maximum(hillshade, 0, out=hillshade)
+
+    np.sqrt(rise2, out=slope)
+    flat = slope == 0
+    np.arctan(slope, out=slope)
+    np.degrees(slope, out=slope)
+
+    # the gradients are not needed any more, negate dzdx in place
+    np.negative(dzdx, out=dzdx)
+    np.arctan2(dzdy, dzdx, out=aspect)
+    np.degrees(aspect, out=aspect)
+    np.subtract(np.float32(90), aspect, out=aspect)
+    np.mod(aspect, np.float32(360), out=aspect)
+    aspect[flat] = -1
+
+    return slope, aspect, hillshade
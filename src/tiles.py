@@ -0,0 +1,159 @@
+"""
+z/x/y png tile pyramid of a single band raster, for the folium maps.
+
+Tiles follow the slippy map scheme in epsg:3857 and are written as
+palette pngs, with the colormap as the palette built once per pyramid.
+Each tile set has a stamp of the source digest and render settings; a set
+whose stamp differs is cleared and drawn again, otherwise existing tiles
+are kept and only missing ones drawn, so other bounds or zooms add to the
+set. Tiles with no data are not written (leaflet leaves them blank).
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from rasterio.transform import from_origin
+from PIL import Image
+import matplotlib
+
+import utils as reutil
+import cache
+
+TILE_DIR = '../tiles/'
+TILE_PX = 256
+WEB_CRS = 'epsg:3857'
+WEB_MERC_ORIGIN = 20037508.342789244
+MIN_ZOOM = 10
+MAX_ZOOM = 13  # ~19 m pixels, finer than the 30 m RAVG data
+STAMP_FILE = 'tiles.stamp'
+# bump when the way tiles are encoded changes
+TILE_FORMAT = 'palette-png-1'
+
+
+def colormap_lut(cmap='hot', vmax=255):
+    """
+    (256, 4) uint8 rgba of the values 0-255, drawn as cmap(value/vmax)
+    """
+    colors = matplotlib.colormaps[cmap](np.arange(256)/vmax)
+    return np.round(colors*255).astype(np.uint8)
+
+
+def tile_range(bounds, zoom):
+    """
+    First and last tile x and y of the tiles covering epsg:3857 bounds
+    """
+    span = 2*WEB_MERC_ORIGIN/2**zoom
+    last = 2**zoom - 1
+    tx0 = int(np.clip(np.floor((bounds[0]+WEB_MERC_ORIGIN)/span), 0, last))
+    tx1 = int(np.clip(np.floor((bounds[2]+WEB_MERC_ORIGIN)/span), 0, last))
+    ty0 = int(np.clip(np.floor((WEB_MERC_ORIGIN-bounds[3])/span), 0, last))
+    ty1 = int(np.clip(np.floor((WEB_MERC_ORIGIN-bounds[1])/span), 0, last))
+    return tx0, tx1, ty0, ty1
+
+
+def tile_url(tile_dir, name):
+    return os.path.join(tile_dir, name, '{z}', '{x}', '{y}.png')
+
+
+def tile_stamp(in_file, **settings):
+    """
+    sha256 of the source contents, the render settings and TILE_FORMAT
+    """
+    inputs = dict(settings, source=cache.file_digest(in_file), format=TILE_FORMAT)
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def reset_tile_set(set_dir, stamp):
+    """
+    Clear set_dir unless its stamp matches, True if it was cleared
+    """
+    stamp_file = os.path.join(set_dir, STAMP_FILE)
+    if os.path.exists(stamp_file):
+        with open(stamp_file) as f:
+            if f.read().strip() == stamp:
+                return False
+    shutil.rmtree(set_dir, ignore_errors=True)
+    os.makedirs(set_dir)
+    # written up front, so an interrupted render resumes with its tiles
+    with open(stamp_file, 'w') as f:
+        f.write(stamp)
+    return True
+
+
+def write_tile(path, values, lut):
+    """
+    values (uint8) as a palette png, lut is the (256, 4) rgba palette
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = reutil.atomic_path(path)
+    image = Image.fromarray(values, 'P')
+    image.putpalette(lut[:, :3].tobytes())
+    image.save(tmp_file, format='PNG', transparency=lut[:, 3].tobytes())
+    os.replace(tmp_file, path)
+
+
+def render_tiles(in_file, name, bounds=None, tile_dir=TILE_DIR,
+                 min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, cmap='hot', vmax=255,
+                 nodata=255, resampling=Resampling.bilinear):
+    """
+    Tiles of in_file under tile_dir/name/z/x/y.png, for the epsg:3857
+    bounds (default: the whole raster). Values are clipped to 0-255 and
+    colored with cmap(value/vmax). nodata (0-255) is also the palette
+    entry drawn transparent. A change of source or of how tiles look
+    redraws the whole set; other bounds or zooms only draw the tiles the
+    set does not have yet.
+
+    Returns the tile url template.
+    """
+    lut = colormap_lut(cmap, vmax)
+    lut[nodata, 3] = 0
+    # bounds and zooms only select tiles, they do not change how one looks
+    stamp = tile_stamp(in_file, cmap=cmap, vmax=vmax, nodata=nodata,
+                       resampling=resampling)
+    if reset_tile_set(os.path.join(tile_dir, name), stamp):
+        print(f'{name} tiles: source or settings changed, redrawing')
+    written = kept = 0
+    with rasterio.open(in_file) as src:
+        src_bounds = transform_bounds(src.crs, WEB_CRS, *src.bounds)
+        if bounds is None:
+            bounds = src_bounds
+        bounds = (max(bounds[0], src_bounds[0]), max(bounds[1], src_bounds[1]),
+                  min(bounds[2], src_bounds[2]), min(bounds[3], src_bounds[3]))
+        src_nodata = nodata if src.nodata is None else src.nodata
+
+        for zoom in range(min_zoom, max_zoom+1):
+            tx0, tx1, ty0, ty1 = tile_range(bounds, zoom)
+            span = 2*WEB_MERC_ORIGIN/2**zoom
+            # one warped view over all tiles of this zoom, read tile by tile
+            transform = from_origin(-WEB_MERC_ORIGIN + tx0*span,
+                                    WEB_MERC_ORIGIN - ty0*span,
+                                    span/TILE_PX, span/TILE_PX)
+            with WarpedVRT(src, crs=WEB_CRS, transform=transform,
+                           width=(tx1-tx0+1)*TILE_PX,
+                           height=(ty1-ty0+1)*TILE_PX,
+                           src_nodata=src_nodata, nodata=nodata,
+                           resampling=resampling) as vrt:
+                for tx in range(tx0, tx1+1):
+                    for ty in range(ty0, ty1+1):
+                        path = os.path.join(tile_dir, name, str(zoom),
+                                            str(tx), f'{ty}.png')
+                        if os.path.exists(path):
+                            kept += 1
+                            continue
+                        window = rasterio.windows.Window(
+                            (tx-tx0)*TILE_PX, (ty-ty0)*TILE_PX, TILE_PX, TILE_PX)
+                        block = vrt.read(1, window=window, masked=True)
+                        if block.mask.all():
+                            continue
+                        values = np.clip(block.filled(nodata), 0, 255).astype(np.uint8)
+                        write_tile(path, values, lut)
+                        written += 1
+    print(f'{name} tiles: {written} written, {kept} up to date')
+    return tile_url(tile_dir, name)
@@ -3,14 +3,30 @@ import json
 import os
 import geopandas as gp
 import rasterio
-from matplotlib.colors import LightSource
 from pyproj import Transformer, Proj
 import utils as reutil
+import terrain
 import tempfile
-import urllib.request
+import time
+import concurrent.futures
+import requests
 import rasterio.windows
+import instrument
+from rasterio.io import MemoryFile
 from rasterio.transform import Affine
 
+DSM_BASE_URL = "https://elevation.nationalmap.gov/arcgis/rest/services/3DEPElevation/ImageServer/exportImage?"
+FETCH_WORKERS = 8
+FETCH_RETRIES = 5
+FETCH_BACKOFF = 1.0
+
+# dem tiles are cached on a fixed epsg:3857 grid shared by all parcels
+DEM_TILE_DIR = '../data/dem_tiles/'
+TILE_SIZE = 1024  # pixels
+TILE_RES = 1.0  # meters per pixel
+MOSAIC_MAX_PIXELS = 64 * 1024**2  # 256 MB of float32
+WEB_MERC_ORIGIN = 20037508.342789244
+
 #ll_proj = Proj('epsg:4326')
 #dep_proj = Proj('epsg:3857')
 #ll_to_dep_trans = Transformer.from_proj(ll_proj, dep_proj)
@@ -18,7 +34,7 @@ from rasterio.transform import Affine
 """
 STEPS:
 1.Grab DEM
-2.extract slope using np.gradient with a sample length of 10m(?)
+2.extract slope, aspect and hillshade with a Horn 3x3 kernel (terrain.py)
 """
 
 
@@ -28,11 +44,10 @@ def parse_bbox(bbox):
     return bbox_str, size_str
 
 
-def dsm_url(bbox_3857):
+def dsm_url(bbox_3857, base_url=DSM_BASE_URL):
     #bbox_3857 = (ll_to_dep_trans.transform(
     #    bbox[1], bbox[0])+ll_to_dep_trans.transform(bbox[3], bbox[2]))
     bbox_str, size_str = parse_bbox(bbox_3857)
-    base_url = "https://elevation.nationalmap.gov/arcgis/rest/services/3DEPElevation/ImageServer/exportImage?"
     bbox_url = f"&bbox={bbox_str}"
     size_url = f"&size={size_str}"
     tail_url = "&format=tiff&pixelType=F32&noDataInterpretation=esriNoDataMatchAny&interpolation=+RSP_BilinearInterpolation&renderingRule=rasterFunction%3AIdentity&f=image"
@@ -67,31 +82,184 @@ def block_shapes(width, height, rows, cols):
             yield rasterio.windows.Window(i, j, num_cols, num_rows)
 
 
-def get_dsm_tiff(sch_buf, outfile, dst_crs, overwrite=False):
+def make_session(workers=FETCH_WORKERS):
+    """
+    Keep-alive session with a connection pool large enough for all workers
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_block(session, url, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+    """
+    Download one exportImage tile and decode it in memory.
+    Retries with exponential backoff on http errors and on bodies that are
+    not a readable raster (the service answers some failures with json).
+    """
+    for attempt in range(retries):
+        try:
+            resp = session.get(url, timeout=120)
+            resp.raise_for_status()
+            instrument.count('downloaded', len(resp.content))
+            with MemoryFile(resp.content) as mem:
+                with mem.open() as src:
+                    return src.read(1)
+        except (requests.RequestException, rasterio.errors.RasterioIOError) as err:
+            if attempt == retries - 1:
+                raise
+            wait = backoff * 2**attempt
+            print(f'tile fetch failed ({err}), retrying in {wait}s')
+            time.sleep(wait)
+
+
+def fetch_blocks(bboxes, base_url=DSM_BASE_URL, workers=FETCH_WORKERS):
+    """
+    Generator of (key, block) for a dict of {key: bbox_3857}, fetched
+    concurrently over a pooled session. Blocks are yielded as they arrive,
+    not in key order.
+    """
+    with make_session(workers) as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for key, bbox in bboxes.items():
+            url = dsm_url(bbox, base_url=base_url)
+            futures[pool.submit(fetch_block, session, url)] = key
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+def tile_bounds(tile):
+    """
+    epsg:3857 bounds of grid tile (tx, ty), counted from the top left of
+    the web mercator extent like slippy map tiles
+    """
+    tx, ty = tile
+    span = TILE_SIZE*TILE_RES
+    xmin = -WEB_MERC_ORIGIN + tx*span
+    ymax = WEB_MERC_ORIGIN - ty*span
+    return (xmin, ymax-span, xmin+span, ymax)
+
+
+def tiles_for_bounds(bbox):
+    """
+    Set of grid tiles covering an epsg:3857 bbox
+    """
+    span = TILE_SIZE*TILE_RES
+    tx0 = int(np.floor((bbox[0]+WEB_MERC_ORIGIN)/span))
+    tx1 = int(np.floor((bbox[2]+WEB_MERC_ORIGIN)/span))
+    ty0 = int(np.floor((WEB_MERC_ORIGIN-bbox[3])/span))
+    ty1 = int(np.floor((WEB_MERC_ORIGIN-bbox[1])/span))
+    return {(tx, ty) for tx in range(tx0, tx1+1) for ty in range(ty0, ty1+1)}
+
+
+def tile_path(tile, tile_dir=DEM_TILE_DIR):
+    return f'{tile_dir}/{TILE_SIZE}px_{TILE_RES:g}m/{tile[0]}_{tile[1]}.tif'
+
+
+def fetch_tiles(tiles, tile_dir=DEM_TILE_DIR, base_url=DSM_BASE_URL,
+                workers=FETCH_WORKERS):
+    """
+    Download the grid tiles that are not in the on-disk cache yet.
+    Returns the number of tiles fetched.
+    """
+    missing = {tile: tile_bounds(tile) for tile in tiles
+               if not os.path.exists(tile_path(tile, tile_dir))}
+    if not missing:
+        return 0
+    print(f'fetching {len(missing)} of {len(tiles)} dem tiles')
+    os.makedirs(os.path.dirname(tile_path((0, 0), tile_dir)), exist_ok=True)
+    for tile, block in fetch_blocks(missing, base_url=base_url, workers=workers):
+        meta = {'driver': 'GTiff',
+                'crs': 'epsg:3857',
+                'transform': rasterio.transform.from_bounds(
+                    *tile_bounds(tile), TILE_SIZE, TILE_SIZE),
+                'width': TILE_SIZE,
+                'height': TILE_SIZE,
+                'count': 1,
+                'dtype': 'float32',
+                'compress': 'deflate',
+                'predictor': 3,
+                'tiled': True,
+                }
+        outfile = tile_path(tile, tile_dir)
+        # other parcel workers may be reading the cache, write atomically
+        tmp_file = reutil.atomic_path(outfile)
+        with rasterio.open(tmp_file, 'w', **meta) as dst:
+            dst.write(block.astype('float32'), 1)
+        os.replace(tmp_file, outfile)
+    return len(missing)
+
+
+def prefetch_tiles(aois, tile_dir=DEM_TILE_DIR, base_url=DSM_BASE_URL,
+                   workers=FETCH_WORKERS):
+    """
+    Fetch the union of grid tiles for a set of aois (e.g. every buffered
+    parcel of a watershed run) so that each tile is downloaded only once.
+
+    Params:
+    aois: GeoSeries or GeoDataFrame with crs specified
+    """
+    tiles = set()
+    for geom in aois.to_crs('epsg:3857').geometry:
+        tiles |= tiles_for_bounds(geom.bounds)
+    return fetch_tiles(tiles, tile_dir=tile_dir, base_url=base_url,
+                       workers=workers)
+
+
+def aoi_tiles(sch_buf, tile_dir=DEM_TILE_DIR, base_url=DSM_BASE_URL,
+              workers=FETCH_WORKERS):
+    """
+    Paths of the grid tiles get_dsm_tiff builds sch_buf from, in a stable
+    order, fetching the ones not in the cache yet
+    """
+    bbox = sch_buf.to_crs('epsg:3857').geometry.unary_union.bounds
+    tiles = tiles_for_bounds(bbox)
+    fetch_tiles(tiles, tile_dir=tile_dir, base_url=base_url, workers=workers)
+    return [tile_path(tile, tile_dir) for tile in sorted(tiles)]
+
+
+def get_dsm_tiff(sch_buf, outfile, dst_crs, overwrite=False,
+                 base_url=DSM_BASE_URL, workers=FETCH_WORKERS,
+                 tile_dir=DEM_TILE_DIR):
     """
-    Get the dsm tiff from the web
+    Get the dsm tiff from the web. The aoi is built from grid aligned
+    tiles in tile_dir, only tiles missing from the cache are downloaded.
 
     Params:
     sch_buf: geopandas df with crs specified
+    base_url: exportImage endpoint, point at a local stand-in for testing
+    workers: number of tiles fetched concurrently
+    tile_dir: on-disk dem tile cache shared by all parcels
     """
-    
+
     if os.path.exists(outfile) and not overwrite:
         print(f'{outfile} exists...skiping download')
         return outfile
 
     sch_buf_3857 = sch_buf.to_crs('epsg:3857')
-    
+
     # if the area is too big, downsample raster
     if (sch_buf_3857.area/1e6).iloc[0] > 10:
         res = 2
     else:
         res = None
 
+    # snap the bbox outwards to the tile grid pixels
     bbox = sch_buf_3857.geometry.unary_union.bounds
-    width = int(bbox[2]-bbox[0])
-    height = int(bbox[3]-bbox[1])
-    transform = rasterio.transform.from_bounds(*bbox, width, height)
-    windows = block_shapes(width, height, 2048, 2048)
+    xmin = np.floor((bbox[0]+WEB_MERC_ORIGIN)/TILE_RES)*TILE_RES - WEB_MERC_ORIGIN
+    xmax = np.ceil((bbox[2]+WEB_MERC_ORIGIN)/TILE_RES)*TILE_RES - WEB_MERC_ORIGIN
+    ymin = WEB_MERC_ORIGIN - np.ceil((WEB_MERC_ORIGIN-bbox[1])/TILE_RES)*TILE_RES
+    ymax = WEB_MERC_ORIGIN - np.floor((WEB_MERC_ORIGIN-bbox[3])/TILE_RES)*TILE_RES
+    width = int(round((xmax-xmin)/TILE_RES))
+    height = int(round((ymax-ymin)/TILE_RES))
+    transform = rasterio.transform.from_origin(xmin, ymax, TILE_RES, TILE_RES)
+
+    tiles = tiles_for_bounds(bbox)
+    fetch_tiles(tiles, tile_dir=tile_dir, base_url=base_url, workers=workers)
 
     meta={'driver': 'GTiff',
           'crs': 'epsg:3857',
@@ -100,53 +268,115 @@ def get_dsm_tiff(sch_buf, outfile, dst_crs, overwrite=False):
           'height': height,
           'count': 1,
           'dtype': 'float32',
-          
         }
-    with tempfile.NamedTemporaryFile(suffix='.tif', delete=True) as tmp:
-        with rasterio.open(tmp, 'w', **meta) as dst:
-            for window in windows:
-                bbox = rasterio.windows.bounds(window, transform)
-                dem_str = dsm_url(bbox)
-                with tempfile.NamedTemporaryFile(suffix='.tif', delete=True) as tmp_block:
-                    urllib.request.urlretrieve(dem_str, tmp_block.name)
-                    with rasterio.open(tmp_block.name) as src:
-                        block = src.read(1)
-                dst.write_band(1, block,window=window)
+    # the mosaic is only an input of the reprojection, kept in memory
+    # unless it is large
+    if width*height <= MOSAIC_MAX_PIXELS:
+        mosaic = MemoryFile()
+    else:
+        mosaic = tempfile.NamedTemporaryFile(suffix='.tif', delete=True)
+    with mosaic as tmp:
+        with rasterio.open(tmp.name, 'w', **meta) as dst:
+            for tile in tiles:
+                # offset of the tile in the output grid
+                txmin, _, _, tymax = tile_bounds(tile)
+                col_off = int(round((txmin-xmin)/TILE_RES))
+                row_off = int(round((ymax-tymax)/TILE_RES))
+                c0, c1 = max(col_off, 0), min(col_off+TILE_SIZE, width)
+                r0, r1 = max(row_off, 0), min(row_off+TILE_SIZE, height)
+                if c0 >= c1 or r0 >= r1:
+                    continue
+                with rasterio.open(tile_path(tile, tile_dir)) as src:
+                    block = src.read(1, window=rasterio.windows.Window(
+                        c0-col_off, r0-row_off, c1-c0, r1-r0))
+                dst.write_band(1, block, window=rasterio.windows.Window(
+                    c0, r0, c1-c0, r1-r0))
 
         #reproject and resample
         reutil.geotiff_to_utm(
             tmp.name, outfile, dst_crs, resolution=res)
-                    
+
     return outfile
 
 
-def dsm_products(outfile, hillshade=True, slope=True):
-    # read the dsm tiff and create products
-    ##########################
+def read_with_halo(src, window, halo=1):
+    """
+    Read window plus up to halo pixels on each side (fewer at the raster
+    edges). Returns the block and the slices that strip the halo again.
+    """
+    r0 = max(window.row_off - halo, 0)
+    c0 = max(window.col_off - halo, 0)
+    r1 = min(window.row_off + window.height + halo, src.height)
+    c1 = min(window.col_off + window.width + halo, src.width)
+    block = src.read(1, window=rasterio.windows.Window(c0, r0, c1-c0, r1-r0))
+    top = window.row_off - r0
+    left = window.col_off - c0
+    inner = (slice(top, top+window.height), slice(left, left+window.width))
+    return block, inner
+
+
+def read_padded(src, window):
+    """
+    window with a one pixel border, taken from the neighbouring pixels
+    where there are any and replicated from the edge at the raster border
+    """
+    block, inner = read_with_halo(src, window)
+    pad = ((inner[0].start, block.shape[0] - inner[0].stop),
+           (inner[1].start, block.shape[1] - inner[1].stop))
+    pad = tuple((1 - before, 1 - after) for before, after in pad)
+    return np.pad(block, pad, mode='edge')
+
+
+def dsm_products(outfile, hillshade=True, slope=True, aspect=True,
+                 block_size=2048):
+    """
+    Hillshade, slope and aspect tiffs of the dsm at outfile, from one
+    gradient pass per block (see terrain.py).
+
+    The dem is processed in block_size tiles with a one pixel halo, so the
+    3x3 kernel at tile edges sees the same neighbours as on the whole array
+    and the output does not depend on the tiling, while memory stays
+    bounded by the tile size. block_size=None processes the whole array
+    in one piece.
+    """
     with rasterio.open(outfile, 'r') as src:
-        data = src.read(1)
         meta = src.meta
-        bounds = src.bounds
-        res = src.res
-
-        # save hillshade tiff
-        if hillshade:
-            ls = LightSource(azdeg=315, altdeg=45)
-            hill = ls.hillshade(data, vert_exag=1)
-            hillshade_file = outfile.replace('.tif', '_hillshade.tif')
-            with rasterio.open(hillshade_file, 'w', **meta) as dst:
-                dst.write(hill.astype(meta['dtype']), 1)
-
-        # save the slope tiff
-        if slope:
-            gradient = np.gradient(data)
-            slope = np.sqrt(gradient[0]**2++gradient[1]**2)*(1/np.mean(res))
-            slope_deg = np.arctan(slope)*180/np.pi
-            slope_file = outfile.replace('.tif', '_slope.tif')
-            with rasterio.open(slope_file, 'w', **meta) as dst:
-                dst.write(slope_deg, 1)
-
-        return hillshade_file, slope_file
+        meta.update({'dtype': 'float32'})
+        xres, yres = src.res
+        if block_size is None:
+            windows = [rasterio.windows.Window(0, 0, src.width, src.height)]
+        else:
+            windows = list(block_shapes(src.width, src.height,
+                                        block_size, block_size))
+
+        names = {'hillshade': hillshade, 'slope': slope, 'aspect': aspect}
+        files = {name: outfile.replace('.tif', f'_{name}.tif')
+                 for name, wanted in names.items() if wanted}
+        dsts = {name: rasterio.open(path, 'w', **meta)
+                for name, path in files.items()}
+
+        # buffers sized for the largest window, reused for every block
+        rows = max(w.height for w in windows)
+        cols = max(w.width for w in windows)
+        bufs = [np.empty((rows, cols), np.float32) for _ in range(5)]
+        try:
+            for window in windows:
+                padded = read_padded(src, window)
+                h, w = window.height, window.width
+                slope_arr, aspect_arr, hill_arr, dzdx, dzdy = [
+                    b[:h, :w] for b in bufs]
+                terrain.products(padded, xres, yres,
+                                 slope=slope_arr, aspect=aspect_arr,
+                                 hillshade=hill_arr, scratch=(dzdx, dzdy))
+                out = {'hillshade': hill_arr, 'slope': slope_arr,
+                       'aspect': aspect_arr}
+                for name, dst in dsts.items():
+                    dst.write(out[name], 1, window=window)
+        finally:
+            for dst in dsts.values():
+                dst.close()
+
+    return files.get('hillshade'), files.get('slope'), files.get('aspect')
 
 
 if __name__ == "__main__":
@@ -1,15 +1,117 @@
+import os
+import math
+import threading
+import contextlib
+import collections
 import rasterio
 import numpy as np
 from rasterio.warp import reproject, Resampling, calculate_default_transform
 import rasterio.mask
+import rasterio.features
+import rasterio.windows
+import rasterio.transform
+from rasterio.io import MemoryFile
+from rasterio.vrt import WarpedVRT
 
+# in memory raster, array is (bands, rows, cols) as from src.read().
+# The transforms below take a path or a Raster and return a Raster when no
+# out_file is given, so intermediates need not go through GeoTIFF files.
+Raster = collections.namedtuple('Raster', ['array', 'transform', 'crs', 'nodata'])
 
-def geotiff_to_utm(in_file, out_file, dst_crs, resolution=None, resampling=Resampling.bilinear):
+
+def atomic_path(out_file):
+    """
+    Temporary sibling of out_file, unique to this process and thread.
+    Write here and os.replace onto out_file so that concurrent workers
+    never see a partial file.
+    """
+    return f'{out_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def read_raster(in_file):
     with rasterio.open(in_file) as src:
-        meta = src.meta
+        return Raster(src.read(), src.transform, src.crs, src.nodata)
+
+
+def raster_meta(raster):
+    count, height, width = raster.array.shape
+    return {'driver': 'GTiff', 'dtype': raster.array.dtype.name,
+            'count': count, 'height': height, 'width': width,
+            'crs': raster.crs, 'transform': raster.transform,
+            'nodata': raster.nodata}
+
+
+@contextlib.contextmanager
+def open_raster(raster):
+    """
+    Dataset of a path, or of a Raster through an in memory GeoTIFF (for
+    the readers that need a dataset, e.g. WarpedVRT)
+    """
+    if not isinstance(raster, Raster):
+        with rasterio.open(raster) as src:
+            yield src
+        return
+    with MemoryFile() as mem:
+        with mem.open(**raster_meta(raster)) as dst:
+            dst.write(raster.array)
+        with mem.open() as src:
+            yield src
+
+
+def write_raster(raster, out_file):
+    tmp_file = atomic_path(out_file)
+    with rasterio.open(tmp_file, 'w', **raster_meta(raster)) as dst:
+        dst.write(raster.array)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def output(raster, out_file=None):
+    """
+    raster, or out_file when given, written from raster
+    """
+    if out_file is None:
+        return raster
+    return write_raster(raster, out_file)
+
+
+def geotiff_to_utm(in_file, out_file=None, dst_crs=None, resolution=None,
+                   resampling=Resampling.bilinear):
+    """
+    in_file (path or Raster) reprojected to dst_crs, by default its own
+    crs (e.g. to only resample it to resolution)
+    """
+    if isinstance(in_file, Raster):
+        # the array goes into reproject as it is, no dataset needed
+        count, height, width = in_file.array.shape
+        dst_crs = dst_crs or in_file.crs
+        transform, dst_width, dst_height = calculate_default_transform(
+            in_file.crs, dst_crs, width, height,
+            *rasterio.transform.array_bounds(height, width, in_file.transform),
+            resolution=resolution)
+        arr = np.zeros((count, dst_height, dst_width), in_file.array.dtype)
+        reproject(source=in_file.array, destination=arr,
+                  src_transform=in_file.transform, src_crs=in_file.crs,
+                  src_nodata=in_file.nodata, dst_transform=transform,
+                  dst_crs=dst_crs, resampling=resampling)
+        return output(Raster(arr, transform, dst_crs, in_file.nodata), out_file)
+
+    with rasterio.open(in_file) as src:
+        dst_crs = dst_crs or src.crs
         transform, width, height = calculate_default_transform(
             src.crs, dst_crs, src.width, src.height, *src.bounds,
             resolution=resolution)
+        warp = dict(src_transform=src.transform, src_crs=src.crs,
+                    dst_transform=transform, dst_crs=dst_crs,
+                    resampling=resampling)
+        if out_file is None:
+            arr = np.zeros((src.count, height, width), src.dtypes[0])
+            for i in range(1, src.count + 1):
+                reproject(source=rasterio.band(src, i), destination=arr[i-1],
+                          **warp)
+            return Raster(arr, transform, dst_crs, src.nodata)
+
+        meta = src.meta
         meta.update({
             'driver': 'GTiff',
             'crs': dst_crs,
@@ -17,31 +119,64 @@ def geotiff_to_utm(in_file, out_file, dst_crs, resolution=None, resampling=Resam
             'width': width,
             'height': height
         })
-        with rasterio.open(out_file, 'w', **meta) as dst:
+        tmp_file = atomic_path(out_file)
+        with rasterio.open(tmp_file, 'w', **meta) as dst:
             for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=dst_crs,
-                    resampling=resampling)
+                reproject(source=rasterio.band(src, i),
+                          destination=rasterio.band(dst, i), **warp)
+    os.replace(tmp_file, out_file)
     return out_file
 
 
-def crop_to_aoi(in_file, aoi, out_file, nodata=np.NaN):
-    with rasterio.open(in_file, 'r') as src:
+def mask_array(raster, aoi, nodata=np.NaN):
+    """
+    rasterio.mask.mask(..., crop=True) of a Raster, done on its array:
+    cropped to the pixels covering aoi, nodata outside aoi and where the
+    raster has no data
+    """
+    _, height, width = raster.array.shape
+    lefts, bottoms, rights, tops = zip(*[rasterio.features.bounds(shape)
+                                         for shape in aoi])
+    window = rasterio.windows.from_bounds(min(lefts), min(bottoms), max(rights),
+                                          max(tops), raster.transform)
+    row0 = max(math.floor(window.row_off), 0)
+    col0 = max(math.floor(window.col_off), 0)
+    row1 = min(math.ceil(window.row_off + window.height), height)
+    col1 = min(math.ceil(window.col_off + window.width), width)
+    if row0 >= row1 or col0 >= col1:
+        raise ValueError('Input shapes do not overlap raster.')
+    window = rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0)
+    trans = rasterio.windows.transform(window, raster.transform)
+    arr = raster.array[:, row0:row1, col0:col1]
+    outside = rasterio.features.geometry_mask(aoi, out_shape=arr.shape[1:],
+                                              transform=trans)
+    missing = np.zeros(arr.shape, bool)
+    if raster.nodata is not None:
+        missing = np.isnan(arr) if np.isnan(raster.nodata) else arr == raster.nodata
+    arr = np.ma.array(arr, mask=missing | outside).filled(nodata)
+    return arr, trans
+
+
+def crop_to_aoi(in_file, aoi, out_file=None, nodata=np.NaN):
+    if isinstance(in_file, Raster):
+        arr, trans = mask_array(in_file, aoi, nodata=nodata)
+        return output(Raster(arr, trans, in_file.crs, in_file.nodata), out_file)
+    with rasterio.open(in_file) as src:
         arr, trans = rasterio.mask.mask(src, aoi, nodata=nodata, crop=True)
-        meta = src.meta
-        meta.update({
-            "driver": "GTiff",
-            "height": arr.shape[1],
-            "width": arr.shape[2],
-            'transform': trans,
-        })
+        crs, src_nodata = src.crs, src.nodata
+    return output(Raster(arr, trans, crs, src_nodata), out_file)
 
-        with rasterio.open(out_file, 'w', **meta) as dst:
-            dst.write(arr)
 
-    return out_file
+def warp_crop_to_aoi(in_file, aoi, out_file=None, dst_crs=None, nodata=np.NaN,
+                     resampling=Resampling.bilinear):
+    """
+    crop_to_aoi of in_file reprojected to dst_crs. The reprojection is a
+    WarpedVRT, so only the window covering aoi is read and warped instead
+    of writing out the whole reprojected raster first.
+    """
+    with open_raster(in_file) as src:
+        dst_crs = dst_crs or src.crs
+        with WarpedVRT(src, crs=dst_crs, resampling=resampling) as vrt:
+            arr, trans = rasterio.mask.mask(vrt, aoi, nodata=nodata, crop=True)
+            vrt_nodata = vrt.nodata
+    return output(Raster(arr, trans, dst_crs, vrt_nodata), out_file)
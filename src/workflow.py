@@ -1,4 +1,5 @@
 import os
+import concurrent.futures
 import pandas as pd
 import geopandas as gp
 import rasterio
@@ -8,151 +9,262 @@ import usgs_dsm
 import naip
 import plotting
 import utils as reutil
+import cache
 import document
 import table
+import results
+import run_manifest
+import instrument
+import zonal
 import folium_map
 
 BA_FILE = "../data/ca3987612137920210714_20201012_20211015_ravg_data/ca3987612137920210714_20201012_20211015_rdnbr_ba.tif"
 DST_CRS = "epsg:32610"
+DEM_BUFFER = 15  # meters around the parcel
 
 
-def process_apn(sch):
+def contour_params(area_km2):
+    """
+    (interval, contour step, line width, label font size) of the contour
+    figure for a parcel of area_km2
+    """
+    if area_km2 > 10:
+        return 50, 10, 0.25, 2
+    elif area_km2 > 0.1 and area_km2 <= 10:
+        return 20, 4, 0.25, 4
+    else:
+        return 10, 1, 1, 5
+
+
+def dem_digests(sch_buf):
+    """
+    Digests of the dem tiles under the buffered parcel
+    """
+    return [cache.file_digest(path) for path in usgs_dsm.aoi_tiles(sch_buf)]
+
+
+def process_apn(sch, plot_workers=1, quality='production', doc_backend='latex',
+                write_figures=True):
+    """
+    Figures and table row of one parcel. With the latex backend the
+    document is built afterwards by document.make_documents, the native
+    backend writes it here while the figures are drawn.
+
+    Params:
+    plot_workers: figures rendered in parallel processes (keep at 1 when
+                  the parcels themselves run in a process pool, ignored by
+                  the native backend)
+    quality: 'preview' or 'production' figure dpi
+    doc_backend: one of document.BACKENDS
+    write_figures: native backend only, False skips the figure files of
+                   the report pages
+    """
 
     # processing for this APN parcel
-    tempdir = '../data/tmp/'
-    if not os.path.exists(tempdir):
-        os.makedirs(tempdir)
-    figdir = f'../fig/{sch.Name.iloc[0]}'
-    if not os.path.exists(figdir):
-        os.makedirs(figdir)
+    name = sch.Name.iloc[0]
+    instrument.set_context(apn=name)
+    with instrument.span('process_apn'):
+        return _process_apn(sch, name, plot_workers, quality, doc_backend,
+                            write_figures)
+
+
+def _process_apn(sch, name, plot_workers, quality, doc_backend, write_figures):
+    figdir = f'../fig/{name}'
+    os.makedirs(figdir, exist_ok=True)
+    geom_hash = run_manifest.geometry_hash(sch.geometry.iloc[0])
 
     sch_utm = sch.to_crs(DST_CRS)
-    sch_utm_buf = sch_utm.buffer(15)
+    sch_utm_buf = sch_utm.buffer(DEM_BUFFER)
     sch_buf = sch_utm_buf.to_crs('epsg:4326')
 
-    # dem
+    # dem, redone only when the parcel or the dem settings change
     demfile = f'{figdir}/dem.tif'
-    demfile = usgs_dsm.get_dsm_tiff(sch_buf, demfile, dst_crs=DST_CRS)
-    hillshade_file, slope_file = usgs_dsm.dsm_products(demfile)
+    with instrument.span('dem'):
+        demfile = run_manifest.run_stage(
+            name, 'dem',
+            {'geometry': geom_hash, 'buffer': DEM_BUFFER, 'crs': DST_CRS,
+             'source': usgs_dsm.DSM_BASE_URL, 'tiles': dem_digests(sch_buf)},
+            lambda: usgs_dsm.get_dsm_tiff(sch_buf, demfile, dst_crs=DST_CRS,
+                                          overwrite=True))
+    with instrument.span('terrain'):
+        hillshade_file, slope_file, aspect_file = run_manifest.run_stage(
+            name, 'terrain', {'dem': cache.file_digest(demfile)},
+            lambda: usgs_dsm.dsm_products(demfile))
 
     # ba
-    ba_filename = os.path.basename(BA_FILE)
-    ba_utm = f"{tempdir}{ba_filename.replace('.tif', '_utm.tif')}"
-    ba_utm = reutil.geotiff_to_utm(BA_FILE, ba_utm, dst_crs=DST_CRS)
-    ba_utm_crop = ba_utm.replace('.tif', '_crop.tif')
-    sch_utm_buf_large = sch_utm.buffer(30)
-    ba_utm_crop = reutil.crop_to_aoi(ba_utm, sch_utm_buf_large, ba_utm_crop)
-    ba_utm_crop_upsample = ba_utm_crop.replace('.tif', '_resample.tif')
-    with rasterio.open(demfile) as src:
-        res = src.res
-    reutil.geotiff_to_utm(ba_utm_crop, ba_utm_crop_upsample, dst_crs=DST_CRS,
-                          resolution=res, resampling=Resampling.nearest)
-
-    # naip
+    # the reprojected RAVG raster is the same for every parcel, so it comes
+    # out of the artifact cache after the first run. The parcel crop and
+    # its resampling to the dem grid stay in memory.
+    with instrument.span('ba'):
+        ba_utm = cache.cached(reutil.geotiff_to_utm, BA_FILE, dst_crs=DST_CRS)
+        sch_utm_buf_large = sch_utm.buffer(30)
+        ba_utm_crop = reutil.crop_to_aoi(ba_utm, sch_utm_buf_large)
+        with rasterio.open(demfile) as src:
+            res = src.res
+        ba_utm_crop_upsample = reutil.geotiff_to_utm(
+            ba_utm_crop, dst_crs=DST_CRS, resolution=res,
+            resampling=Resampling.nearest)
+
+    # naip, redone when the parcel or the quads under it change
     naip_file = f'{figdir}/naip.tif'
-    if not os.path.exists(naip_file):
-        naip_file = naip.get_masked_raster(
-            sch, masked_file=naip_file)
-    else:
-        print(f"{naip_file} exists, skipping creation...")
+    with instrument.span('naip'):
+        naip_sources = naip.get_sources(sch)
+        naip_file = run_manifest.run_stage(
+            name, 'naip',
+            {'geometry': geom_hash, 'crs': DST_CRS,
+             'sources': naip.source_digests(naip_sources)},
+            lambda: naip.mask_raster(naip_sources[0][1], sch, DST_CRS,
+                                     masked_file=naip_file))
 
     # plotting
     # ------------------------------
     area_km2 = (sch_utm.area/1e6).iloc[0]
-    if area_km2 > 10:
-        intv, cont, linethick, cfont = 50, 10, 0.25, 2
-    elif area_km2 > 0.1 and area_km2 <= 10:
-        intv, cont, linethick, cfont = 20, 4, 0.25, 4
-    else:
-        intv, cont, linethick, cfont = 10, 1, 1, 5
-
-    plotting.plot_contour(demfile, sch_utm, figdir,
-                          intv=intv, cont=cont, linethick=linethick, cfont=cfont)
-    plotting.plot_hill(hillshade_file, sch_utm, figdir)
-    plotting.plot_slope(slope_file, sch_utm, figdir)
-    plotting.plot_ba(ba_utm_crop_upsample, sch_utm, figdir)
-    plotting.plot_naip(naip_file, sch_utm, figdir)
-
-    _, cell_text = plotting.plot_regen(slope_file, ba_utm_crop_upsample,
-                                       naip_file, sch_utm, figdir)
+    intv, cont, linethick, cfont = contour_params(area_km2)
 
-    # collect in document
-    document.make_document(figdir)
+    # in the page order of the document (see document.PAGES)
+    jobs = [
+        ('plot_regen', (slope_file, ba_utm_crop_upsample,
+                        naip_file, sch_utm, figdir), {}),
+        ('plot_ba', (ba_utm_crop_upsample, sch_utm, figdir), {}),
+        ('plot_slope', (slope_file, sch_utm, figdir), {}),
+        ('plot_contour', (demfile, sch_utm, figdir),
+         dict(intv=intv, cont=cont, linethick=linethick, cfont=cfont)),
+        ('plot_naip', (naip_file, sch_utm, figdir), {}),
+        ('plot_hill', (hillshade_file, sch_utm, figdir), {}),
+    ]
+    with instrument.span('figures'):
+        if doc_backend == 'native':
+            with document.native_document(figdir, write_figures=write_figures):
+                results = plotting.render(jobs, quality=quality)
+        else:
+            results = plotting.render(jobs, workers=plot_workers, quality=quality)
+    _, cell_text = results[0]
 
     # return dict of values
-    all_75 = cell_text[0][3]+cell_text[1][3]+cell_text[2][3]
-
-    sub = pd.DataFrame({'APN': sch.Name.iloc[0],
-                        'BA>75 All Slopes': all_75,
-                        'BA>75 & S>30': cell_text[0][3],
-                        'BA>75 & 30>S>15': cell_text[1][3],
-                        'BA>75 & S<15': cell_text[2][3],
-                        'BA<75,BA>50  and S>30': cell_text[0][2],
-                        'BA<75,BA>50  and 30>S>15': cell_text[1][2],
-                        'BA<75,BA>50 and S<15': cell_text[2][2],
-                        'BA<50,BA>25 and S>30': cell_text[0][1],
-                        'BA<50,BA>25 and 30>S>15': cell_text[1][1],
-                        'BA<50,BA>25 and S<15': cell_text[2][1],
-                        'BA<25 and S>30': cell_text[0][0],
-                        'BA<25 and 30>S>15': cell_text[1][0],
-                        'BA<25 and S<15': cell_text[2][0],
-                        'geometry': [sch.geometry.iloc[0]],
-                        }, index=[sch.Name.iloc[0]]
-                       )
+    sub = table.apn_row(name, cell_text, sch.geometry.iloc[0])
     return sub
 
 
-if __name__ == "__main__":
+def zonal_table(val_gdf, workdir='../fig/zonal', db_file=results.RESULTS_DB):
+    """
+    BA x slope table of every parcel from one watershed wide slope raster
+    (see zonal.py), without the per parcel figures and documents. Rows go
+    to the zonal table of the results store, apart from the per parcel rows.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    union = gp.GeoDataFrame(geometry=[val_gdf.unary_union], crs=val_gdf.crs)
+    union_buf = union.to_crs(DST_CRS).buffer(DEM_BUFFER).to_crs('epsg:4326')
+    demfile = f'{workdir}/dem.tif'
+    demfile = run_manifest.run_stage(
+        'zonal', 'dem',
+        {'geometry': run_manifest.geometry_hash(union.geometry.iloc[0]),
+         'buffer': DEM_BUFFER, 'crs': DST_CRS, 'source': usgs_dsm.DSM_BASE_URL,
+         'tiles': dem_digests(union_buf)},
+        lambda: usgs_dsm.get_dsm_tiff(union_buf, demfile, dst_crs=DST_CRS,
+                                      overwrite=True))
+    _, slope_file, _ = run_manifest.run_stage(
+        'zonal', 'terrain', {'dem': cache.file_digest(demfile)},
+        lambda: usgs_dsm.dsm_products(demfile, hillshade=False, aspect=False))
+    ba_utm = cache.cached(reutil.geotiff_to_utm, BA_FILE, dst_crs=DST_CRS)
+
+    acres = zonal.zonal_acres(val_gdf, slope_file, ba_utm)
+    subs = [table.apn_row(name, acres[name], geom)
+            for name, geom in zip(val_gdf['Name'], val_gdf.geometry)]
+    results.store(pd.concat(subs), db_file=db_file, table=results.ZONAL_TABLE)
 
-    parcel_file = '../data/plumas_parsels.geojson'
-    # warner_valley_file = "../data/warner_valley_bounds.geojson"
-    warner_valley_file = "../data/warner_watershed.geojson"
 
-    # ---------------------------------
-    gdf = gp.read_file(parcel_file)
-    val = gp.read_file(warner_valley_file)
-    # ---------------------------------
+def apn_inputs(sch, **kwargs):
     """
-    # this produces all parcels touching the watershed
-    val_gdf = gp.sjoin(gdf, val, how='inner', op='intersects')
-    val['Name'] = 'Warner_Watershed'
-    val_gdf = pd.concat([val, val_gdf])
-    val_gdf.crs = 'epsg:4326'
+    Everything the figures and row of a parcel depend on, for the run
+    manifest. The dem tiles and naip quads of the parcel are fetched (and
+    the quads merged) here if they are not cached yet.
     """
-    # ---------------------------------
-    # this produces all area interior to the watershed
-    val_gdf = gp.overlay(gdf, val, how='intersection')
-    val['Name'] = 'Warner_Watershed'
-    extra = gp.overlay(val, val_gdf, how='difference')
-    val_gdf = val_gdf.append(extra)
-
-    #These overlap with 011100025
-    val_gdf = val_gdf[~(val_gdf['Name'].isin(['011100007', '011100008']))]
-    
-    # ---------------------------------
-    apns = val_gdf.Name.to_list()
-
-    # 'Tolanda'
-    # apns = ['011180013']
-
-    # 'Williams'
-    # apns = ['011180014']
-
-    # 'Farmers'
-    # apns = ['011130013']
-
-    # all watershed
-    # apns = ['Warner_Watershed']
-
-    for ii, apn in enumerate(apns):
-        print(f'Processing {apn}')
-        sch = val_gdf[val_gdf['Name'] == apn]
-        sub = process_apn(sch)
-        if ii == 0:
-            df = sub
-        else:
-            df = pd.concat([df, sub])
+    params = {key: value for key, value in kwargs.items()
+              if key != 'plot_workers'}
+    sch_buf = sch.to_crs(DST_CRS).buffer(DEM_BUFFER).to_crs('epsg:4326')
+    return {'geometry': run_manifest.geometry_hash(sch.geometry.iloc[0]),
+            'ba': cache.file_digest(BA_FILE), 'buffer': DEM_BUFFER,
+            'dem': dem_digests(sch_buf),
+            'naip': naip.source_digests(naip.get_sources(sch)),
+            'crs': DST_CRS, 'params': params}
+
+
+def run_apns(val_gdf, apns, workers=1, db_file=results.RESULTS_DB,
+             force=False, **kwargs):
+    """
+    Run process_apn for each apn, serially or over a process pool. Each
+    row is written to the results store as soon as its parcel finishes.
+
+    Parcels whose inputs are unchanged since their last finished run, and
+    whose row is in the store, are skipped (unless force), so an
+    interrupted run resumes with the parcels it had not finished.
+    """
+    schs = {apn: val_gdf[val_gdf['Name'] == apn] for apn in apns}
+    stamps = {apn: run_manifest.fingerprint(apn_inputs(schs[apn], **kwargs))
+              for apn in apns}
+    stored = set()
+    if results.has_results(db_file):
+        stored = set(results.read(db_file).index)
+    todo = [apn for apn in apns
+            if force or apn not in stored
+            or run_manifest.current(apn, 'apn', stamps[apn]) is None]
+    print(f'{len(apns) - len(todo)} of {len(apns)} parcels up to date')
+
+    def finish(apn, sub):
+        results.store(sub, db_file=db_file)
+        run_manifest.record(apn, 'apn', stamps[apn], f'../fig/{apn}')
 
-    table.to_table(df)
+    if workers <= 1:
+        for apn in todo:
+            print(f'Processing {apn}')
+            finish(apn, process_apn(schs[apn], **kwargs))
+        return
+
+    # shared lookups are built here once, not by every worker at once
+    naip.prepare()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_apn, schs[apn], **kwargs): apn
+                   for apn in todo}
+        for future in concurrent.futures.as_completed(futures):
+            apn = futures[future]
+            finish(apn, future.result())
+            print(f'Finished {apn}')
+
+
+def process(val_gdf, apns, workers=1, plot_workers=1, quality='production',
+            doc_backend='latex', doc_workers=document.DOC_WORKERS,
+            force=False, zonal_only=False, write_figures=False):
+    """
+    Everything for apns: the per parcel figures and rows (or only the
+    rows, zonal_only), the documents, the table and the map.
+    With the native backend the report pages are only written into the
+    pdf, unless write_figures (the latex backend always needs the files).
+    """
+    if zonal_only:
+        zonal_table(val_gdf[val_gdf['Name'].isin(apns)])
+        table.to_table(results.read(apns=apns, table=results.ZONAL_TABLE))
+        return
+
+    # download every dem tile of the run once, up front
+    run_gdf = val_gdf[val_gdf['Name'].isin(apns)]
+    usgs_dsm.prefetch_tiles(run_gdf.to_crs(DST_CRS).buffer(DEM_BUFFER))
+
+    # the latex build reads the figure files, so they are always written there
+    kwargs = {'write_figures': write_figures} if doc_backend == 'native' else {}
+    run_apns(val_gdf, apns, workers=workers, plot_workers=plot_workers,
+             quality=quality, doc_backend=doc_backend, force=force, **kwargs)
+
+    if doc_backend == 'latex':
+        # collect in documents, unchanged parcels are skipped
+        document.make_documents([f'../fig/{apn}' for apn in apns],
+                                workers=doc_workers)
+
+    table.to_table(results.read(apns=apns))
     folium_map.warner(val_gdf)
 
+
+if __name__ == "__main__":
+    # same as cli.py process
+    import sys
+    import cli
+    cli.main(['process'] + sys.argv[1:])
@@ -0,0 +1,62 @@
+import numpy as np
+import rasterio
+import rasterio.features
+from rasterio.warp import reproject, Resampling
+
+import regen
+
+
+def zonal_acres(gdf, slope_file, ba_file, name_col='Name'):
+    """
+    BA x slope acres of every parcel in gdf from a single pass over a
+    watershed wide slope raster.
+
+    Parcel ids are burned onto the slope grid once, the BA raster is
+    resampled onto the same grid, and the acres of all parcels come from
+    one bincount over (parcel, class). Acres are scaled to the polygon
+    area like plot_regen does.
+
+    Returns dict of name -> (3, 4) acres as nested lists
+    """
+    with rasterio.open(slope_file) as src:
+        slope = src.read(1)
+        transform = src.transform
+        crs = src.crs
+        res = src.res
+
+    with rasterio.open(ba_file) as src:
+        ba = np.full(slope.shape, np.nan, np.float32)
+        reproject(source=rasterio.band(src, 1),
+                  destination=ba,
+                  src_transform=src.transform,
+                  src_crs=src.crs,
+                  dst_transform=transform,
+                  dst_crs=crs,
+                  dst_nodata=np.nan,
+                  resampling=Resampling.nearest)
+
+    gdf_crs = gdf.to_crs(crs)
+    # ids start at 1, 0 is outside every parcel
+    ids = rasterio.features.rasterize(
+        ((geom, i+1) for i, geom in enumerate(gdf_crs.geometry)),
+        out_shape=slope.shape, transform=transform, fill=0, dtype='int32')
+
+    n_parcels = len(gdf_crs) + 1
+    n_labels = regen.N_CLASSES + 2
+    labels = ids.astype(np.int64).ravel() * n_labels
+    labels += regen.classify(slope, ba).ravel()
+    counts = np.bincount(labels, minlength=n_parcels*n_labels)
+    counts = counts.reshape(n_parcels, n_labels)[1:]
+
+    pixel_acres = res[0]*res[1]*(1/regen.M2_IN_ACRE)
+    # everything but NO_DATA has a finite slope
+    acres_raster = counts[:, :regen.NO_DATA].sum(axis=1)*pixel_acres
+    acres_poly = gdf_crs.area.values/regen.M2_IN_ACRE
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fac = np.where(acres_raster > 0, acres_poly/acres_raster, 0)
+
+    out = {}
+    for name, row, f in zip(gdf_crs[name_col], counts, fac):
+        acres = row[:regen.N_CLASSES] * pixel_acres * f
+        out[name] = np.round(acres, 2).reshape(regen.N_ROWS, regen.N_COLS).tolist()
+    return out
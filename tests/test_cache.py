@@ -0,0 +1,36 @@
+import os
+import concurrent.futures
+
+import cache
+
+
+def write_bytes(in_file, out_file, size):
+    with open(out_file, 'wb') as f:
+        f.write(b'x' * size)
+    return out_file
+
+
+def test_new_artifact_survives_eviction(tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(b'source')
+    cache_dir = str(tmp_path / 'cache')
+
+    first = cache.cached(write_bytes, str(src), cache_dir=cache_dir,
+                         max_bytes=10, size=8)
+    assert os.path.exists(first)
+    # larger than max_bytes on its own, and evicts the older artifact
+    second = cache.cached(write_bytes, str(src), cache_dir=cache_dir,
+                          max_bytes=10, size=20)
+    assert os.path.exists(second)
+    assert not os.path.exists(first)
+
+
+def test_file_digest_from_many_threads(tmp_path):
+    src = tmp_path / 'template.tex'
+    src.write_bytes(b'template')
+    cache_dir = str(tmp_path / 'cache')
+    # every thread finds no memo and writes its own
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        digests = list(pool.map(lambda _: cache.file_digest(str(src), cache_dir=cache_dir),
+                                range(64)))
+    assert len(set(digests)) == 1
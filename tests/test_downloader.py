@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+
+import downloader
+
+
+def test_claim_is_exclusive(tmp_path):
+    outfile = str(tmp_path / 'quad.tif')
+    assert downloader.claim(outfile)
+    assert not downloader.claim(outfile)
+    os.remove(downloader.lock_path(outfile))
+    assert downloader.claim(outfile)
+
+
+def test_claim_of_dead_process_is_taken_over(tmp_path):
+    outfile = str(tmp_path / 'quad.tif')
+    dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                          stdout=subprocess.PIPE, check=True)
+    with open(downloader.lock_path(outfile), 'w') as f:
+        f.write(dead.stdout.decode().strip())
+    assert downloader.claim(outfile)
+    with open(downloader.lock_path(outfile)) as f:
+        assert int(f.read()) == os.getpid()
@@ -0,0 +1,25 @@
+import json
+import tracemalloc
+
+import instrument
+
+
+def test_nested_span_keeps_outer_peak(tmp_path):
+    trace_file = str(tmp_path / 'trace.jsonl')
+    instrument.configure(trace_file, tracemalloc_on=True)
+    try:
+        with instrument.span('outer'):
+            big = bytearray(20 * 1024**2)
+            del big
+            with instrument.span('inner'):
+                small = bytearray(1024**2)
+                del small
+    finally:
+        instrument.configure(None)
+        tracemalloc.stop()
+
+    with open(trace_file) as f:
+        peaks = {record['stage']: record['tracemalloc_peak']
+                 for record in map(json.loads, f)}
+    assert peaks['inner'] < 10 * 1024**2
+    assert peaks['outer'] >= 20 * 1024**2
@@ -0,0 +1,59 @@
+import numpy as np
+import rasterio
+from rasterio.merge import merge
+from rasterio.transform import from_origin
+
+import naip
+
+
+def write_source(path, west, north, shape, res=1.0, nodata=None, seed=0):
+    data = np.random.RandomState(seed).randint(1, 255, (3,) + shape).astype(np.uint8)
+    if nodata is not None:
+        data[:, :5, :5] = nodata
+    with rasterio.open(path, 'w', driver='GTiff', width=shape[1], height=shape[0],
+                       count=3, dtype='uint8', crs='epsg:26910', nodata=nodata,
+                       transform=from_origin(west, north, res, res)) as dst:
+        dst.write(data)
+    return str(path)
+
+
+def test_merge_rasters_matches_merge_off_grid(tmp_path):
+    # overlapping quads whose origins are off the mosaic grid by a fraction
+    # of a pixel, one at a coarser resolution
+    files = [
+        write_source(tmp_path / 'a.tif', 0.0, 100.0, (70, 90), seed=1),
+        write_source(tmp_path / 'b.tif', 60.4, 130.3, (80, 75), nodata=0, seed=2),
+        write_source(tmp_path / 'c.tif', 30.7, 60.6, (65, 110), seed=3),
+        write_source(tmp_path / 'd.tif', -20.2, 40.8, (20, 30), res=2.5, seed=4),
+    ]
+    expected, expected_trans = merge([rasterio.open(f) for f in files])
+
+    outfile = str(tmp_path / 'mosaic.tif')
+    naip.merge_rasters(files, outfile, block_size=32)
+    with rasterio.open(outfile) as src:
+        assert src.transform == expected_trans
+        np.testing.assert_array_equal(src.read(), expected)
+
+
+def test_merge_rasters_matches_merge_grid_rounding(tmp_path):
+    # the coarser source reaches 0.4 px past the rounded mosaic grid
+    files = [
+        write_source(tmp_path / 'a.tif', 0.3, 100.0, (40, 40), seed=1),
+        write_source(tmp_path / 'e.tif', -10.0, 60.6, (50, 50), res=1.7, seed=5),
+    ]
+    expected, expected_trans = merge([rasterio.open(f) for f in files])
+
+    outfile = str(tmp_path / 'mosaic.tif')
+    naip.merge_rasters(files, outfile, block_size=32)
+    with rasterio.open(outfile) as src:
+        assert src.transform == expected_trans
+        np.testing.assert_array_equal(src.read(), expected)
+
+
+def test_project_coords_empty_parts():
+    coords = [[], [[[-121.3, 40.4], [-121.2, 40.4], [-121.2, 40.5], [-121.3, 40.4]], []]]
+    projected = naip.project_coords(coords, 'epsg:4326', 'epsg:4326')
+    assert projected[0] == [] and projected[1][1] == []
+    # same as the ring projected on its own
+    expected = naip.project_coords(coords[1][0], 'epsg:4326', 'epsg:4326')
+    np.testing.assert_allclose(projected[1][0], expected)
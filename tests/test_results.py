@@ -0,0 +1,37 @@
+import os
+
+import pytest
+import shapely.geometry
+
+import results
+import table
+
+
+def test_read_missing_store(tmp_path):
+    db_file = str(tmp_path / 'results.sqlite')
+    with pytest.raises(results.MissingResults, match='cli.py process'):
+        results.read(db_file)
+    assert not os.path.exists(db_file)
+
+
+def test_store_and_read(tmp_path):
+    db_file = str(tmp_path / 'results.sqlite')
+    cell_text = [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12]]
+    geom = shapely.geometry.box(0, 0, 1, 1)
+    results.store(table.apn_row('011180013', cell_text, geom), db_file=db_file)
+    df = results.read(db_file, geometry=True)
+    assert list(df.index) == ['011180013']
+    assert df['BA>75 All Slopes'].iloc[0] == 24
+    assert df['geometry'].iloc[0].equals(geom)
+
+
+def test_zonal_rows_kept_apart(tmp_path):
+    db_file = str(tmp_path / 'results.sqlite')
+    geom = shapely.geometry.box(0, 0, 1, 1)
+    parcel = [[1, 1, 1, 1]] * 3
+    zonal = [[2, 2, 2, 2]] * 3
+    results.store(table.apn_row('a', parcel, geom), db_file=db_file)
+    results.store(table.apn_row('a', zonal, geom), db_file=db_file,
+                  table=results.ZONAL_TABLE)
+    assert results.read(db_file)['BA>75 All Slopes'].iloc[0] == 3
+    assert results.read(db_file, table=results.ZONAL_TABLE)['BA>75 All Slopes'].iloc[0] == 6
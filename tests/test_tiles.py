@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import tiles
+
+
+def tile_files(tile_dir):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(tile_dir)
+                  for name in names if name.endswith('.png'))
+
+
+def test_settings_change_redraws_tiles(tmp_path, monkeypatch):
+    # the digest memo goes to ../data/cache relative to the working dir
+    os.makedirs(tmp_path / 'src')
+    monkeypatch.chdir(tmp_path / 'src')
+    in_file = str(tmp_path / 'ba.tif')
+    with rasterio.open(in_file, 'w', driver='GTiff', width=50, height=50, count=1,
+                       dtype='uint8', crs='epsg:3857',
+                       transform=from_origin(-13510000, 4930000, 100, 100)) as dst:
+        dst.write(np.arange(2500).reshape(50, 50).astype(np.uint8) % 100, 1)
+    tile_dir = str(tmp_path / 'tiles')
+
+    tiles.render_tiles(in_file, 'ba', tile_dir=tile_dir, min_zoom=10, max_zoom=11)
+    first = {path: os.path.getmtime(path) for path in tile_files(tile_dir)}
+    assert first
+
+    # unchanged: every tile is kept
+    tiles.render_tiles(in_file, 'ba', tile_dir=tile_dir, min_zoom=10, max_zoom=11)
+    assert {path: os.path.getmtime(path) for path in tile_files(tile_dir)} == first
+
+    # another zoom range adds its tiles and keeps the others
+    tiles.render_tiles(in_file, 'ba', tile_dir=tile_dir, min_zoom=11, max_zoom=12)
+    both = {path: os.path.getmtime(path) for path in tile_files(tile_dir)}
+    assert {path: both[path] for path in first} == first
+    assert any(os.sep + '12' + os.sep in path for path in both)
+
+    # a stale tile left by other settings is removed, the set redrawn
+    stale = os.path.join(tile_dir, 'ba', '9', '0', '0.png')
+    os.makedirs(os.path.dirname(stale))
+    open(stale, 'wb').close()
+    tiles.render_tiles(in_file, 'ba', tile_dir=tile_dir, min_zoom=10, max_zoom=11,
+                       vmax=100)
+    assert not os.path.exists(stale)
+    assert tile_files(tile_dir) == sorted(first)